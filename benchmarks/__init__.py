@@ -0,0 +1,14 @@
+"""Benchmarks for tv2.
+
+generate makes synthetic notes directories to benchmark against, run times
+tv2 on them and writes the timings as JSON, and compare compares two JSON
+files of timings. For example:
+
+    python -m benchmarks.run --notes 20000 --output before.json
+    ...
+    python -m benchmarks.run --notes 20000 --output after.json
+    python -m benchmarks.compare before.json after.json
+
+memory measures how much memory a notebook's notes take.
+
+"""
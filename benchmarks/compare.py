@@ -0,0 +1,60 @@
+"""Compare two JSON files of benchmark results made by run.py.
+
+    python -m benchmarks.compare before.json after.json
+
+Prints the median time of each benchmark in both runs and their ratio.
+Exits with status 1 if any benchmark got slower by more than --threshold.
+
+"""
+import argparse
+import json
+import sys
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(before, after, threshold=1.2):
+    """Compare two results dicts.
+
+    Returns a list of (name, median before, median after, ratio,
+    regressed) tuples for the benchmarks that have timings in both.
+
+    """
+    rows = []
+    for name in sorted(set(before) & set(after)):
+        old = before[name].get("median")
+        new = after[name].get("median")
+        if not old or new is None:
+            continue
+        ratio = new / old
+        rows.append((name, old, new, ratio, ratio > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before", help="the results to compare against")
+    parser.add_argument("after", help="the new results")
+    parser.add_argument("--threshold", type=float, default=1.2,
+            help="the slowdown ratio that counts as a regression "
+                "(default: %(default)s)")
+    args = parser.parse_args()
+
+    rows = compare(load_results(args.before), load_results(args.after),
+            args.threshold)
+    width = max([len(row[0]) for row in rows] + [len("benchmark")])
+    print("{0:<{1}}  {2:>12}  {3:>12}  {4:>7}".format(
+        "benchmark", width, "before (s)", "after (s)", "ratio"))
+    for name, old, new, ratio, regressed in rows:
+        print("{0:<{1}}  {2:>12.6f}  {3:>12.6f}  {4:>6.2f}x{5}".format(
+            name, width, old, new, ratio, "  SLOWER" if regressed else ""))
+    if any(row[4] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
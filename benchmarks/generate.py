@@ -0,0 +1,154 @@
+"""Generate synthetic notes directories for benchmarking.
+
+    python -m benchmarks.generate /tmp/notes --notes 10000 --depth 3
+
+The notes are made from a fixed vocabulary by a seeded random number
+generator, so the same arguments always make the same notes directory.
+
+"""
+import argparse
+import os
+import random
+
+
+# Words that notes are made of. A few aren't ASCII, so that non-ASCII search
+# words and encodings other than UTF-8 get exercised.
+VOCABULARY = (
+    "the of and to in is that for it as was with be by on not he this are or "
+    "his from at which but have an they you were her she there been one all "
+    "python decorator generator iterator module package import class method "
+    "function argument keyword exception traceback logging thread process "
+    "meeting agenda minutes action review project deadline budget roadmap "
+    "recipe flour butter sugar oven bake knead dough yeast salt pepper "
+    "garden tomato basil water seed soil compost harvest weed spring summer "
+    "TODO FIXME Monday Tuesday Wednesday Thursday Friday London Paris Berlin "
+    "café naïve façade über résumé jalapeño smörgåsbord déjà vu"
+    ).split()
+
+DEFAULT_ENCODINGS = (("utf-8", 1.0),)
+
+
+def parse_encodings(value):
+    """Parse an encoding mix like "utf-8=0.9,latin-1=0.1".
+
+    Returns a tuple of (encoding, weight) tuples. An encoding without a
+    weight gets a weight of 1.
+
+    """
+    encodings = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, weight = item.partition("=")
+        encodings.append((name.strip(), float(weight) if weight else 1.0))
+    return tuple(encodings)
+
+
+def make_directories(depth, fanout):
+    """Return the relative paths of a tree of directories.
+
+    The tree has `fanout` subdirectories per directory, `depth` levels deep,
+    and the notes directory itself ("") is included.
+
+    """
+    directories = [""]
+    level = [""]
+    for i in range(depth):
+        level = [os.path.join(parent, "dir{0}-{1}".format(i, j))
+                for parent in level for j in range(fanout)]
+        directories.extend(level)
+    return directories
+
+
+def make_text(rng, size):
+    """Return about `size` characters of random words, in lines."""
+
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(VOCABULARY)
+        words.append(word)
+        length += len(word) + 1
+        if rng.random() < 0.08:
+            words.append("\n")
+    return " ".join(words).replace(" \n ", "\n")
+
+
+def generate(path, notes=1000, depth=2, fanout=4, note_size=2000,
+        encodings=DEFAULT_ENCODINGS, extension=".txt", seed=0):
+    """Fill the directory `path` with synthetic notes.
+
+    Returns the number of bytes written.
+
+    Arguments:
+    path -- the notes directory, made if it doesn't exist (string)
+    notes -- how many notes to make (int)
+    depth -- how many levels of subdirectories to put notes in (int)
+    fanout -- how many subdirectories each directory has (int)
+    note_size -- the average size of a note, in characters (int). Sizes are
+        exponentially distributed around this, so a few notes are much bigger.
+    encodings -- the encodings to save notes in, with the relative
+        proportion of notes to save in each one (tuple of (string, float)
+        tuples). Characters that an encoding can't represent are replaced.
+    extension -- the filename extension of the notes (string)
+    seed -- the random seed (int)
+
+    """
+    rng = random.Random(seed)
+    directories = make_directories(depth, fanout)
+    for directory in directories:
+        dir_path = os.path.join(path, directory)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    names = [name for name, weight in encodings]
+    weights = [weight for name, weight in encodings]
+    total_bytes = 0
+    for i in range(notes):
+        title = "{0} {1}".format(
+                " ".join(rng.choice(VOCABULARY)
+                    for _ in range(rng.randint(1, 4))),
+                i)
+        directory = rng.choice(directories)
+        text = title + "\n\n" + make_text(
+                rng, int(rng.expovariate(1.0 / note_size)))
+        encoding = rng.choices(names, weights)[0]
+        data = text.encode(encoding, "replace")
+        with open(os.path.join(path, directory, title + extension),
+                "wb") as f:
+            f.write(data)
+        total_bytes += len(data)
+    return total_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="the notes directory to make")
+    parser.add_argument("--notes", type=int, default=1000,
+            help="how many notes to make (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=2,
+            help="how many levels of subdirectories (default: %(default)s)")
+    parser.add_argument("--fanout", type=int, default=4,
+            help="subdirectories per directory (default: %(default)s)")
+    parser.add_argument("--note-size", type=int, default=2000,
+            help="the average note size, in characters "
+                "(default: %(default)s)")
+    parser.add_argument("--encodings", type=parse_encodings,
+            default=DEFAULT_ENCODINGS,
+            help="the encodings to save notes in and their proportions, e.g. "
+                "utf-8=0.9,latin-1=0.1 (default: utf-8)")
+    parser.add_argument("--seed", type=int, default=0,
+            help="the random seed (default: %(default)s)")
+    args = parser.parse_args()
+
+    total_bytes = generate(args.path, notes=args.notes, depth=args.depth,
+            fanout=args.fanout, note_size=args.note_size,
+            encodings=args.encodings, seed=args.seed)
+    print("Wrote {0} notes ({1} bytes) to {2}".format(
+        args.notes, total_bytes, args.path))
+
+
+if __name__ == "__main__":
+    main()
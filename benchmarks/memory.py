@@ -0,0 +1,181 @@
+"""Measure how much memory a notebook's notes take and write JSON results.
+
+    python -m benchmarks.memory --notes 1000000 --output memory.json
+
+The notes are made up rather than read from a notes directory (no files are
+written), so a million of them only take seconds. Memory is measured with
+tracemalloc, after each of these steps:
+
+- notes: making a PlainTextNoteBook and adding the notes to it
+- title-ordering: the notebook's title ordering (used by sorting and title
+  prefix lookups)
+- mtime-ordering: the notebook's mtime ordering, with each note's times set
+  as if its file had been stat-ed
+
+Each result gives the bytes allocated by the step and the bytes per note.
+Pass --notes-dir to measure reading a real notes directory instead.
+
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from tv2 import notebook
+
+from . import generate
+
+
+def make_titles(notes, depth=2, fanout=4, seed=0):
+    """Return `notes` note titles like the ones generate.generate() makes."""
+
+    rng = random.Random(seed)
+    directories = generate.make_directories(depth, fanout)
+    titles = []
+    for i in range(notes):
+        title = "{0} {1}".format(
+                " ".join(rng.choice(generate.VOCABULARY)
+                    for _ in range(rng.randint(1, 4))),
+                i)
+        titles.append(os.path.join(rng.choice(directories), title))
+    return titles
+
+
+class Measurer(object):
+    """Measures the memory allocated by successive steps."""
+
+    def __init__(self):
+        self.results = {}
+        gc.collect()
+        tracemalloc.start()
+        self._last = tracemalloc.get_traced_memory()[0]
+
+    def record(self, name, notes):
+        gc.collect()
+        current = tracemalloc.get_traced_memory()[0]
+        allocated = current - self._last
+        self._last = current
+        self.results[name] = {
+            "bytes": allocated,
+            "bytes_per_note": allocated / notes if notes else None,
+            "notes": notes,
+            }
+        sys.stderr.write("{0}: {1:.1f} MB, {2:.0f} bytes per note\n".format(
+            name, allocated / 1024.0 / 1024.0,
+            self.results[name]["bytes_per_note"] or 0))
+
+    def stop(self):
+        tracemalloc.stop()
+
+
+def measure_synthetic(path, titles, extension=".txt"):
+    """Measure a notebook of made-up notes, return the results dict.
+
+    Arguments:
+    path -- an empty directory to use as the notes directory (string)
+    titles -- the titles of the notes (list of strings)
+
+    """
+    measurer = Measurer()
+    try:
+        nb = notebook.PlainTextNoteBook(path, extension, [extension],
+                load=False)
+        nb._add_loaded([notebook.PlainTextNote(title, nb, extension,
+                create=False) for title in titles])
+        measurer.record("notes", len(nb))
+
+        nb.sort(order="title")
+        measurer.record("title-ordering", len(nb))
+
+        for i, note in enumerate(nb):
+            # Distinct floats, like the times of real files.
+            note._mtime = note._ctime = 1.5e9 + i
+        nb.sort(order="mtime")
+        measurer.record("mtime-ordering", len(nb))
+    finally:
+        measurer.stop()
+    return measurer.results
+
+
+def measure_notes_dir(path, extensions):
+    """Measure reading the notes directory `path`, return the results
+    dict."""
+
+    measurer = Measurer()
+    try:
+        nb = notebook.PlainTextNoteBook(path, extensions[0], extensions)
+        measurer.record("notes", len(nb))
+        nb.sort(order="title")
+        measurer.record("title-ordering", len(nb))
+        nb.sort(order="mtime")
+        measurer.record("mtime-ordering", len(nb))
+    finally:
+        measurer.stop()
+    return measurer.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes-dir",
+            help="measure an existing notes directory instead of made-up "
+                "notes")
+    parser.add_argument("--extensions", default=".txt",
+            help="the note filename extensions to read from --notes-dir, "
+                "comma separated (default: %(default)s)")
+    parser.add_argument("--notes", type=int, default=100000,
+            help="how many notes to make up (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=2,
+            help="how many levels of subdirectories to put the notes in "
+                "(default: %(default)s)")
+    parser.add_argument("--fanout", type=int, default=4,
+            help="subdirectories per directory (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+            help="the random seed (default: %(default)s)")
+    parser.add_argument("-o", "--output",
+            help="the file to write the JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        }
+    if args.notes_dir:
+        meta["notes_dir"] = args.notes_dir
+        results = measure_notes_dir(args.notes_dir,
+                [extension.strip() for extension in
+                    args.extensions.split(",")])
+    else:
+        meta["generated"] = {
+            "notes": args.notes,
+            "depth": args.depth,
+            "fanout": args.fanout,
+            "seed": args.seed,
+            }
+        titles = make_titles(args.notes, depth=args.depth,
+                fanout=args.fanout, seed=args.seed)
+        tmp_dir = tempfile.mkdtemp(prefix="tv2-memory-")
+        try:
+            results = measure_synthetic(tmp_dir, titles)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    output = json.dumps({"meta": meta, "results": results}, indent=2,
+            sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""Time tv2 on a synthetic (or real) notes directory and write JSON results.
+
+    python -m benchmarks.run --notes 20000 --output results.json
+
+Each benchmark is run --repeat times. The benchmarks are:
+
+- construct: making a PlainTextNoteBook, reading the notes directory
+- construct-manifest-cold and construct-manifest-warm: the same, saving a
+  manifest of the notes directory and then using it
+- search/<function>: searching and sorting the results after each keystroke
+  of typing (and partly deleting) some queries, with a new notebook for each
+  repeat, once per search function, and once with an SQLiteNoteBook
+  (search/sqlite)
+- listbox-filter: NoteFilterListBox.filter() with all the notes, and
+  rendering the list box
+- mainframe/<function>: MainFrame.filter() after each keystroke followed by
+  rendering the whole UI to a canvas, as the urwid main loop would
+
+The UI benchmarks are skipped if urwid can't be imported.
+
+The JSON output has a "meta" object describing the run and a "results"
+object mapping each benchmark's name to a summary of its timings, in
+seconds. See compare.py for comparing two runs.
+
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from tv2 import fuzzy
+from tv2 import index
+from tv2 import mmap_search
+from tv2 import notebook
+from tv2 import parallel
+from tv2 import ranking
+from tv2 import sqlite_notebook
+
+from . import generate
+
+
+# Queries typed (one keystroke at a time) in the search benchmarks.
+DEFAULT_QUERIES = ("python decorator", "meeting agenda", "café", "TODO",
+        "bake dough")
+
+# How many characters to delete after typing each query.
+BACKSPACES = 3
+
+# The screen size to render the UI at.
+SCREEN_SIZE = (80, 24)
+
+
+def keystrokes(queries):
+    """Return the search box contents after each keystroke.
+
+    Each query is typed one character at a time, then the last few
+    characters are deleted again, then the search box is cleared.
+
+    """
+    texts = []
+    for query in queries:
+        for i in range(1, len(query) + 1):
+            texts.append(query[:i])
+        for i in range(1, min(BACKSPACES, len(query) - 1) + 1):
+            texts.append(query[:-i])
+        texts.append("")
+    return texts
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    i = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[i]
+
+
+def summarize(timings):
+    """Return a dict summarizing a list of timings (in seconds)."""
+
+    values = sorted(timings)
+    return {
+        "count": len(values),
+        "total": sum(values),
+        "min": values[0] if values else None,
+        "median": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "max": values[-1] if values else None,
+        }
+
+
+def timed(function, *args, **kwargs):
+    """Call `function`, return a (seconds taken, result) tuple."""
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def describe_error(e):
+    return "{0}: {1}".format(type(e).__name__, e)
+
+
+def search_functions(workers=None):
+    """Return a dict of the search functions to benchmark, by name."""
+
+    return {
+        "brute": notebook.brute_force_search,
+        "mmap": mmap_search.mmap_search,
+        "index": index.IndexedSearch(),
+        "process": parallel.ProcessPoolSearch(workers=workers),
+        "rank": ranking.RankedSearch(),
+        "fuzzy": fuzzy.FuzzySearch(),
+        }
+
+
+def remove_sidecars(path):
+    """Remove the saved manifest, index and database of the notes directory
+    `path`."""
+
+    for suffix in ("tv2manifest", "tv2index", "tv2db", "tv2db-wal",
+            "tv2db-shm"):
+        try:
+            os.remove(notebook.sidecar_path(path, suffix))
+        except OSError:
+            pass
+
+
+class Runner(object):
+    """Runs the benchmarks against one notes directory."""
+
+    def __init__(self, path, extension=".txt", repeat=3,
+            queries=DEFAULT_QUERIES, workers=None):
+        self.path = path
+        self.extension = extension
+        self.repeat = repeat
+        self.texts = keystrokes(queries)
+        self.workers = workers
+        self.results = {}
+
+    def record(self, name, timings, **extra):
+        summary = summarize(timings)
+        summary.update(extra)
+        self.results[name] = summary
+        sys.stderr.write("{0}: median {1:.6f}s, p95 {2:.6f}s\n".format(
+            name, summary["median"] or 0, summary["p95"] or 0))
+
+    def notebook(self, notebook_class=None, **kwargs):
+        if notebook_class is None:
+            notebook_class = notebook.PlainTextNoteBook
+        return notebook_class(self.path, self.extension, [self.extension],
+                **kwargs)
+
+    def bench_construct(self):
+        timings = []
+        for _ in range(self.repeat):
+            seconds, nb = timed(self.notebook)
+            timings.append(seconds)
+        self.record("construct", timings, notes=len(nb))
+
+        cold = []
+        warm = []
+        for _ in range(self.repeat):
+            remove_sidecars(self.path)
+            cold.append(timed(self.notebook, manifest=True)[0])
+            warm.append(timed(self.notebook, manifest=True)[0])
+        self.record("construct-manifest-cold", cold)
+        self.record("construct-manifest-warm", warm)
+
+    def bench_search(self, name, search_function, notebook_class=None):
+        timings = []
+        first = []
+        matches = 0
+        try:
+            for _ in range(self.repeat):
+                nb = self.notebook(notebook_class,
+                        search_function=search_function)
+                for i, text in enumerate(self.texts):
+                    start = time.perf_counter()
+                    results = nb.search(text)
+                    if not getattr(results, "ranked", False):
+                        results = nb.sort(results)
+                    seconds = time.perf_counter() - start
+                    if i == 0:
+                        first.append(seconds)
+                    else:
+                        timings.append(seconds)
+                    matches += len(results)
+        except Exception as e:
+            error = describe_error(e)
+            self.results["search/" + name] = {"error": error}
+            sys.stderr.write("search/{0}: {1}\n".format(name, error))
+            return
+        self.record("search/" + name, timings, first=summarize(first),
+                matches=matches)
+
+    def bench_ui(self, functions):
+        try:
+            from tv2 import urwid_ui
+        except ImportError as e:
+            self.results["ui"] = {"skipped": repr(e)}
+            sys.stderr.write("Skipping UI benchmarks: {0!r}\n".format(e))
+            return
+
+        nb = self.notebook()
+        notes = nb.sort()
+        timings = []
+        for _ in range(self.repeat):
+            list_box = urwid_ui.NoteFilterListBox(
+                    on_changed=lambda note: None)
+            start = time.perf_counter()
+            list_box.filter(notes)
+            list_box.render(SCREEN_SIZE, focus=True)
+            timings.append(time.perf_counter() - start)
+        self.record("listbox-filter", timings, notes=len(notes))
+
+        for name, search_function in sorted(functions.items()):
+            timings = []
+            try:
+                for _ in range(self.repeat):
+                    frame = urwid_ui.MainFrame(self.path, "true",
+                            self.extension, [self.extension],
+                            search_function=search_function)
+                    for text in self.texts:
+                        start = time.perf_counter()
+                        frame.filter(text)
+                        canvas = frame.render(SCREEN_SIZE, focus=True)
+                        list(canvas.content())
+                        timings.append(time.perf_counter() - start)
+            except Exception as e:
+                error = describe_error(e)
+                self.results["mainframe/" + name] = {"error": error}
+                sys.stderr.write("mainframe/{0}: {1}\n".format(name, error))
+                continue
+            self.record("mainframe/" + name, timings)
+
+    def run(self, names=None):
+        """Run the benchmarks, return the results dict.
+
+        Arguments:
+        names -- the names of the search functions to benchmark (list of
+            strings, defaults to all of them)
+
+        """
+        functions = search_functions(self.workers)
+        if names:
+            functions = dict((name, functions[name]) for name in names)
+        try:
+            self.bench_construct()
+            for name, search_function in sorted(functions.items()):
+                remove_sidecars(self.path)
+                self.bench_search(name, search_function)
+            if not names:
+                remove_sidecars(self.path)
+                self.bench_search("sqlite", None,
+                        notebook_class=sqlite_notebook.SQLiteNoteBook)
+            self.bench_ui(functions)
+        finally:
+            for search_function in functions.values():
+                if hasattr(search_function, "close"):
+                    search_function.close()
+            remove_sidecars(self.path)
+        return self.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes-dir",
+            help="benchmark an existing notes directory instead of "
+                "generating one (its saved manifest and index are deleted)")
+    parser.add_argument("--notes", type=int, default=5000,
+            help="how many notes to generate (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=2,
+            help="how many levels of subdirectories to generate "
+                "(default: %(default)s)")
+    parser.add_argument("--fanout", type=int, default=4,
+            help="subdirectories per generated directory "
+                "(default: %(default)s)")
+    parser.add_argument("--note-size", type=int, default=2000,
+            help="the average generated note size, in characters "
+                "(default: %(default)s)")
+    parser.add_argument("--encodings", type=generate.parse_encodings,
+            default=generate.DEFAULT_ENCODINGS,
+            help="the encodings to generate notes in and their proportions, "
+                "e.g. utf-8=0.9,latin-1=0.1 (default: utf-8)")
+    parser.add_argument("--seed", type=int, default=0,
+            help="the random seed (default: %(default)s)")
+    parser.add_argument("--search", action="append",
+            choices=sorted(search_functions(1)),
+            help="a search function to benchmark, can be given more than "
+                "once (default: all of them)")
+    parser.add_argument("--workers", type=int, default=None,
+            help="worker processes for the process search function "
+                "(default: one per CPU)")
+    parser.add_argument("--repeat", type=int, default=3,
+            help="how many times to run each benchmark "
+                "(default: %(default)s)")
+    parser.add_argument("-o", "--output",
+            help="the file to write the JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    # Unreadable notes would log an error on every search.
+    logging.basicConfig(level=logging.CRITICAL)
+
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "queries": list(DEFAULT_QUERIES),
+        }
+    tmp_dir = None
+    if args.notes_dir:
+        path = os.path.abspath(os.path.expanduser(args.notes_dir))
+        meta["notes_dir"] = path
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix="tv2-bench-")
+        path = os.path.join(tmp_dir, "notes")
+        seconds, total_bytes = timed(generate.generate, path,
+                notes=args.notes, depth=args.depth, fanout=args.fanout,
+                note_size=args.note_size, encodings=args.encodings,
+                seed=args.seed)
+        meta["generated"] = {
+            "notes": args.notes,
+            "depth": args.depth,
+            "fanout": args.fanout,
+            "note_size": args.note_size,
+            "encodings": [list(e) for e in args.encodings],
+            "seed": args.seed,
+            "bytes": total_bytes,
+            "seconds": seconds,
+            }
+
+    try:
+        runner = Runner(path, repeat=args.repeat, workers=args.workers)
+        results = runner.run(args.search)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    output = json.dumps({"meta": meta, "results": results}, indent=2,
+            sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""tv2's headless mode: search or list notes without the user interface.
+
+    tv2 --query "python decor" --limit 10
+    tv2 --list --ndjson
+
+Matching notes are written to stdout one per line as soon as they're found,
+as absolute paths or, with --ndjson, as JSON objects with the note's title,
+path and mtime. Output stops early once --limit notes have been written.
+
+Searches use the same notebook and search functions as the user interface.
+With brute_force_search the notes are matched one at a time, so the first
+matches are written before the rest of the notes have been read, in no
+particular order. Other search functions find all of their results first,
+ranked search functions write them best first.
+
+Listing doesn't make a notebook at all: note files are written as the notes
+directory is listed.
+
+Several notes directories can be given, see multi_notebook. Their searches
+run at once and the notes found in each are written as soon as it has been
+searched, so a slow directory doesn't hold up the others.
+
+Nothing here imports urwid, so scripts don't pay for loading it.
+
+"""
+import itertools
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import sys
+
+from . import multi_notebook
+from . import notebook as notebook_module
+
+
+def iter_search(notebook, query):
+    """Return an iterator over the notes in `notebook` that match `query`.
+
+    Notes are yielded as they're found if the notebook's search function is
+    brute_force_search, see iter_matching_notes(), or as each notes
+    directory of a MultiNoteBook has been searched.
+
+    """
+    if notebook.search_function is notebook_module.brute_force_search:
+        search_each = getattr(notebook, "search_each", None)
+        if search_each is not None:
+            return itertools.chain.from_iterable(
+                    matching_notes for _, matching_notes in search_each(query))
+        return notebook_module.iter_matching_notes(notebook, query)
+    return iter(notebook.search(query))
+
+
+def iter_note_files(path, extensions, exclude=()):
+    """Yield a (title, abspath) tuple for each note file in a notes directory,
+    as the directory is listed.
+
+    Arguments:
+    path -- absolute path to the notes directory (string)
+    extensions -- the filename extensions of note files (list of strings,
+        each starting with a dot)
+    exclude -- file and directory names to skip (list of strings)
+
+    """
+    for batch in notebook_module.scan_notes_dir(path, extensions, exclude):
+        for title, extension in batch:
+            yield title, os.path.join(path, title + extension)
+
+
+def format_note(title, abspath, mtime=None, ndjson=False):
+    """Return the line of output for a note.
+
+    Arguments:
+    title -- the note's title (string)
+    abspath -- the absolute path to the note's file (string)
+
+    Keyword arguments:
+    mtime -- the note's mtime, the file is stat-ed if it's needed and not
+        given (float)
+    ndjson -- whether to return a JSON object instead of just the path
+        (bool)
+
+    """
+    if not ndjson:
+        return abspath
+    if mtime is None:
+        try:
+            mtime = os.stat(abspath).st_mtime
+        except OSError:
+            mtime = None
+    return json.dumps({"title": title, "path": abspath, "mtime": mtime},
+            ensure_ascii=False)
+
+
+def write_lines(lines, limit=None, out=None):
+    """Write lines to `out` (default: stdout), flushing after each one.
+
+    Stops after `limit` lines, if given, without consuming any more of
+    `lines`. Returns the number of lines written.
+
+    """
+    if out is None:
+        out = sys.stdout
+    count = 0
+    if limit is not None and limit <= 0:
+        return count
+    for line in lines:
+        out.write(line + "\n")
+        out.flush()
+        count += 1
+        if limit is not None and count >= limit:
+            break
+    return count
+
+
+def _normalise_extensions(extensions):
+    return [extension if extension.startswith(".") else "." + extension
+            for extension in extensions]
+
+
+def search(notes_dir, extension, extensions, query, exclude=None,
+        search_function=notebook_module.brute_force_search,
+        notebook_class=notebook_module.PlainTextNoteBook,
+        cache_size=notebook_module.DEFAULT_CACHE_SIZE, rescan=False,
+        limit=None, ndjson=False, out=None):
+    """Write the notes in `notes_dir` that match `query` to `out`.
+
+    Takes the same notebook arguments as urwid_ui.launch(), `notes_dir` may
+    be a list of notes directories. Returns the number of notes written.
+
+    Keyword arguments:
+    limit -- the most notes to write (int, default: all of them)
+    ndjson -- whether to write JSON objects instead of paths (bool)
+    out -- the file to write to (default: stdout)
+
+    """
+    notebook = multi_notebook.make_notebook(notes_dir, extension, extensions,
+            notebook_class=notebook_class, search_function=search_function,
+            exclude=exclude, cache_size=cache_size, manifest=True,
+            rescan=rescan)
+    try:
+        lines = (format_note(note.title, note.abspath,
+                    mtime=note.mtime if ndjson else None, ndjson=ndjson)
+                for note in iter_search(notebook, query))
+        return write_lines(lines, limit=limit, out=out)
+    finally:
+        if hasattr(notebook, "close"):
+            notebook.close()
+
+
+def list_notes(notes_dir, extensions, exclude=None, limit=None,
+        ndjson=False, out=None):
+    """Write all of the notes in `notes_dir` to `out`, as they're found.
+
+    `notes_dir` may be a list of notes directories, they're listed one after
+    the other. Returns the number of notes written.
+
+    Keyword arguments:
+    limit -- the most notes to write (int, default: all of them)
+    ndjson -- whether to write JSON objects instead of paths (bool)
+    out -- the file to write to (default: stdout)
+
+    """
+    if isinstance(notes_dir, str):
+        notes_dir = [notes_dir]
+    extensions = _normalise_extensions(extensions)
+    lines = (format_note(title, abspath, ndjson=ndjson)
+            for path in notes_dir
+            for title, abspath in iter_note_files(
+                os.path.abspath(os.path.expanduser(path)), extensions,
+                exclude or ()))
+    return write_lines(lines, limit=limit, out=out)
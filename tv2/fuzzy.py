@@ -0,0 +1,379 @@
+"""A fuzzy search function that matches note titles like fzf does.
+
+    search = FuzzySearch()
+    notebook = PlainTextNoteBook(path, extension, extensions,
+            search_function=search)
+
+A note matches if each search word is a subsequence of its title: the word's
+characters appear in the title in order, but not necessarily next to each
+other, so "pydec" matches "programming/python/How to use Decorators". Like
+brute_force_search, lower case words match case-insensitively and other
+words case-sensitively. Only titles are searched, note files are never read.
+
+Matches are scored higher when the matched characters are consecutive or
+start words in the title, and lower when they are spread out or the title is
+long, and are returned best first as ranking.RankedResults.
+
+To stay interactive over hundreds of thousands of notes, FuzzySearch keeps a
+TitleIndex of each notebook it searches: the lower-cased titles, and for each
+character a bitmask of the notes whose titles contain it. ANDing together
+the bitmasks of the query's characters rejects every note that can't match
+without looking at it. The TitleIndex also remembers which notes matched
+recent queries, like PlainTextNoteBook's search history: a query that
+refines a recent one (e.g. after typing one more character) only looks at
+the notes that matched it. The remaining candidates are matched against a
+regular expression, and only the notes that match are scored one by one.
+
+"""
+import array
+import contextlib
+import functools
+import gc
+import itertools
+import operator
+import re
+import threading
+
+from . import ranking
+
+
+SCORE_MATCH = 16
+BONUS_BOUNDARY = 8
+BONUS_CONSECUTIVE = 4
+PENALTY_GAP = 1
+MAX_GAP_PENALTY = 8
+PENALTY_LENGTH = 0.05
+
+# Characters that separate the words of a title.
+BOUNDARY_CHARS = frozenset(" /\\-_.,:;()[]{}'\"")
+
+# How many recent queries' matches a TitleIndex remembers. A short query's
+# matches may be most of the notes, so this is kept short.
+HISTORY_SIZE = 8
+
+
+def is_subsequence(word, text):
+    """Return True if the characters of `word` appear in `text` in order."""
+
+    chars = iter(text)
+    return all(ch in chars for ch in word)
+
+
+def refines(search_words, previous_words):
+    """Return True if `search_words` can only fuzzy-match titles that
+    `previous_words` match.
+
+    That is the case when each of the previous words is a subsequence of one
+    of the new search words, e.g. "pyd" refines "py" and "py dec" refines
+    "dc". A case-sensitive previous word must be a subsequence of a
+    case-sensitive new word.
+
+    """
+    for previous_word in previous_words:
+        for search_word in search_words:
+            if previous_word.islower():
+                if is_subsequence(previous_word, search_word.lower()):
+                    break
+            elif (not search_word.islower()) and is_subsequence(
+                    previous_word, search_word):
+                break
+        else:
+            return False
+    return True
+
+
+def subsequence_re(word):
+    """Return a compiled regular expression that matches strings that
+    contain `word` as a subsequence.
+
+    The expression has a group for each character of `word`.
+
+    """
+    return re.compile(".*?".join("(" + re.escape(ch) + ")" for ch in word),
+            re.DOTALL)
+
+
+def fuzzy_score(title, match):
+    """Return the score of a subsequence match in a title.
+
+    Arguments:
+    title -- the title that was matched (string)
+    match -- the match of a subsequence_re() in `title`, or in the
+        lower-cased title if that's the same length (re.Match)
+
+    """
+    start, end = match.span()
+    return _span_score(title, start, end, match.re.groups)
+
+
+def _span_score(title, start, end, length):
+    # The score of `length` characters matched between start and end.
+    gap = end - start - length
+    if gap:
+        score = SCORE_MATCH * length - min(MAX_GAP_PENALTY, PENALTY_GAP * gap)
+    else:
+        score = (SCORE_MATCH + BONUS_CONSECUTIVE) * length - BONUS_CONSECUTIVE
+    if start == 0 or title[start - 1] in BOUNDARY_CHARS or (
+            title[start].isupper() and title[start - 1].islower()):
+        score += BONUS_BOUNDARY
+    return score
+
+
+def _first_char_score(ch, lowercase_title, matched_title):
+    start = lowercase_title.find(ch)
+    if start < 0:
+        return 0
+    return _span_score(matched_title, start, start + 1, 1)
+
+
+class TitleIndex(object):
+    """The lower-cased titles of a list of notes, with per-character bitmasks.
+
+    A character's bitmask is an int with one byte per note, 1 if the note's
+    lower-cased title contains the character and 0 if not, made the first
+    time a query uses the character. ANDing bitmasks together is big integer
+    arithmetic, done in C, so it costs next to nothing per note.
+
+    A one-character search word matches nearly every title, so scoring each
+    match would make the first keystroke of a query the slowest. Instead a
+    character's scores, one byte per note, are worked out once and looked
+    up after that (see char_scores()).
+
+    """
+    def __init__(self, notes):
+        self.notes = list(notes)
+        self.titles = [note.title for note in self.notes]
+        self.lowercase_titles = [title.lower() for title in self.titles]
+        # Lower-casing changes the length of a few strings, then positions
+        # in the lower-cased title aren't positions in the title. These are
+        # the titles that matches in the lower-cased titles are scored on.
+        self.matched_titles = [
+                title if len(title) == len(lowercase_title)
+                else lowercase_title
+                for title, lowercase_title
+                in zip(self.titles, self.lowercase_titles)]
+        self.length_penalties = [PENALTY_LENGTH * len(title)
+                for title in self.titles]
+        self._masks = {}  # character -> bitmask
+        self._char_scores = {}  # character -> bytes
+        self._history = []  # (search words, indices of the matching notes)
+        self._lock = threading.Lock()
+
+    def mask(self, ch):
+        """Return the bitmask of the notes whose titles contain `ch`."""
+
+        with self._lock:
+            mask = self._masks.get(ch)
+            if mask is None:
+                mask = self._masks[ch] = int.from_bytes(
+                        bytes([ch in title
+                            for title in self.lowercase_titles]),
+                        "little")
+            return mask
+
+    def char_scores(self, ch, make=True):
+        """Return the scores of the (lower case) search word `ch` against
+        each lower-cased title, as bytes, 0 if the title doesn't contain it.
+
+        If the scores haven't been worked out yet and `make` is False,
+        returns None.
+
+        """
+        with self._lock:
+            scores = self._char_scores.get(ch)
+            if scores is None and make:
+                scores = self._char_scores[ch] = bytes([
+                        _first_char_score(ch, lowercase_title, matched_title)
+                        for lowercase_title, matched_title in zip(
+                            self.lowercase_titles, self.matched_titles)])
+            return scores
+
+    def candidates(self, chars, search_words=None):
+        """Return an iterator over the indices of the notes whose titles
+        contain all of the (lower case) characters `chars`, in order.
+
+        If `search_words` are given and refine a recent query's (see
+        remember()), only the notes that matched that query are returned.
+
+        """
+        if not self.notes:
+            return iter([])
+        mask = functools.reduce(operator.and_,
+                [self.mask(ch) for ch in set(chars)])
+        flags = mask.to_bytes(len(self.notes), "little")
+        previous_matches = None
+        if search_words is not None:
+            previous_matches = self.recall(search_words)
+        if previous_matches is None:
+            return itertools.compress(range(len(self.notes)), flags)
+        return itertools.compress(previous_matches,
+                map(flags.__getitem__, previous_matches))
+
+    def recall(self, search_words):
+        """Return the indices of the notes that matched the most recent query
+        that `search_words` refines, or None."""
+
+        with self._lock:
+            for i in range(len(self._history) - 1, -1, -1):
+                previous_words, matches = self._history[i]
+                if refines(search_words, previous_words):
+                    return matches
+        return None
+
+    def remember(self, search_words, matches):
+        """Remember the indices of the notes that matched a query (sequence of
+        ints)."""
+
+        with self._lock:
+            self._history.append((tuple(search_words), matches))
+            del self._history[:-HISTORY_SIZE]
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    # Scoring a short query allocates a tuple per match, hundreds of
+    # thousands of them, which sets off the cyclic garbage collector over and
+    # over, each time going through every object in a large notebook. The
+    # tuples can't be part of a cycle, so there's nothing for it to find.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class FuzzySearch(object):
+    """A search function that fuzzy-matches note titles."""
+
+    # Each notebook's whole TitleIndex is searched. It narrows searches down
+    # to the notes that matched a previous query itself (see
+    # TitleIndex.recall()), by subsequence rather than substring.
+    searches_subsets = False
+
+    # Only titles are searched, no note files are read.
+    reads_content_cache = False
+
+    def __init__(self, k=ranking.DEFAULT_K):
+        """Make a new FuzzySearch.
+
+        Keyword arguments:
+        k -- how many of the best matching notes to rank up front, see
+            ranking.RankedResults (int)
+
+        """
+        self.k = k
+        self._indexes = {}  # notebook id -> (generation, TitleIndex)
+        self._generations = {}  # notebook id -> count of notes added/removed
+
+    def title_index(self, notes):
+        """Return an up to date TitleIndex of `notes`.
+
+        A NoteBook's TitleIndex is kept and remade when notes are added to or
+        removed from it, or loaded into it (see
+        PlainTextNoteBook.load_batches()). Any other sequence of notes gets a
+        new TitleIndex.
+
+        """
+        add_listener = getattr(notes, "add_listener", None)
+        if add_listener is None:
+            return TitleIndex(notes)
+
+        key = id(notes)
+        if key not in self._generations:
+            self._generations[key] = 0
+            add_listener(lambda event, note: self._on_change(key, event))
+        generation = self._generations[key]
+        entry = self._indexes.get(key)
+        if entry is None or entry[0] != generation or (
+                len(entry[1].notes) != len(notes)):
+            entry = self._indexes[key] = (generation, TitleIndex(notes))
+        return entry[1]
+
+    def _on_change(self, key, event):
+        # Called by the notebook. Titles never change, so modified notes
+        # don't matter.
+        if event != "modified":
+            self._generations[key] += 1
+
+    def __call__(self, notes, query):
+        """Return the notes in `notes` whose titles fuzzy-match `query`,
+        best first."""
+
+        search_words = query.strip().split()
+        if not search_words:
+            return list(notes)
+
+        index = self.title_index(notes)
+        candidates = index.candidates("".join(search_words).lower(),
+                search_words)
+        with _gc_paused():
+            scored = self._score(index, candidates, search_words)
+            index.remember(search_words,
+                    array.array("l", [entry[1] for entry in scored]))
+            return ranking.RankedResults(scored, self.k)
+
+    def _score(self, index, candidates, search_words):
+        """Return (-score, position, note) tuples for the candidates that
+        match `search_words`."""
+
+        notes = index.notes
+        titles = index.titles
+        lowercase_titles = index.lowercase_titles
+        matched_titles = index.matched_titles
+        length_penalties = index.length_penalties
+        if len(search_words) == 1 and len(search_words[0]) == 1 and (
+                search_words[0].islower()):
+            # The first keystroke of a query, look its scores up.
+            scores = index.char_scores(search_words[0])
+            return [(length_penalties[i] - scores[i], i, notes[i])
+                    for i in candidates]
+
+        # (search, searched titles, matched titles, scores, length) for each
+        # search word, with the looked up scores of one-character words if
+        # there are any.
+        matchers = []
+        for word in search_words:
+            scores = None
+            if word.islower():
+                searched_titles = lowercase_titles
+                word_matched_titles = matched_titles
+                if len(word) == 1:
+                    scores = index.char_scores(word, make=False)
+            else:
+                searched_titles = word_matched_titles = titles
+            matchers.append((subsequence_re(word).search, searched_titles,
+                    word_matched_titles, scores, len(word)))
+        scored = []
+        for i in candidates:
+            score = -length_penalties[i]
+            for search, searched_titles, word_matched_titles, scores, length \
+                    in matchers:
+                if scores is not None:
+                    score += scores[i]
+                    continue
+                match = search(searched_titles[i])
+                if match is None:
+                    break
+                # _span_score(), inline.
+                start, end = match.span()
+                gap = end - start - length
+                if gap:
+                    gap *= PENALTY_GAP
+                    score += SCORE_MATCH * length - (
+                            gap if gap < MAX_GAP_PENALTY else MAX_GAP_PENALTY)
+                else:
+                    score += (SCORE_MATCH + BONUS_CONSECUTIVE) * length - (
+                            BONUS_CONSECUTIVE)
+                if start:
+                    title = word_matched_titles[i]
+                    if title[start - 1] in BOUNDARY_CHARS or (
+                            title[start].isupper()
+                            and title[start - 1].islower()):
+                        score += BONUS_BOUNDARY
+                else:
+                    score += BONUS_BOUNDARY
+            else:
+                scored.append((-score, i, notes[i]))
+        return scored
@@ -0,0 +1,447 @@
+"""An inverted index search function for PlainTextNoteBooks.
+
+brute_force_search reads every note file for every search, which is too slow
+for large notebooks. IndexedSearch keeps an inverted index from the words in
+each note to the notes that contain them, and answers queries from the index
+instead:
+
+    search = IndexedSearch()
+    notebook = PlainTextNoteBook(path, extension, extensions,
+            search_function=search)
+    matching_notes = notebook.search(query)
+
+The index is pickled to a hidden file beside the notes directory (see
+notebook.sidecar_path()) so that it survives restarts. The first time the
+index is used (once the notebook has loaded) it is brought up to date by
+comparing each note file's mtime and size with the ones recorded in the
+index, only new or modified notes are read and re-tokenized. After that,
+notes that the notebook reports as added, modified or removed (see
+PlainTextNoteBook.add_listener(), and watch.py for changes made outside tv2)
+are re-indexed when the index is next used. Changed indexes are saved by a
+background thread once they've stopped changing for a while, and by close().
+
+Queries have the same semantics as brute_force_search: a note matches if every
+search word is a substring of the note's title or contents, lower case words
+match case-insensitively and other words match case-sensitively.
+
+Substring matches are found by scanning the index's vocabulary (all the
+distinct lower-cased words in the notebook) for words that contain the search
+word, and taking the union of those words' postings. That is exact for
+lower-case search words made of word characters. Search words containing
+upper-case letters or punctuation are narrowed down using the index and then
+checked against the candidate notes' actual titles and contents.
+
+"""
+import array
+import logging
+logger = logging.getLogger(__name__)
+import os
+import pickle
+import re
+import threading
+import time
+
+from . import notebook as notebook_module
+
+
+# Bump this when the pickled index format changes, old indexes are discarded.
+INDEX_VERSION = 1
+
+# Compact the postings when more than this many documents in them are dead.
+MIN_DEAD_TO_COMPACT = 1000
+
+# How long IndexedSearch waits after an index last changed before saving it,
+# in seconds, so that a burst of changes is saved once.
+DEFAULT_SAVE_DELAY = 10.0
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Return the set of distinct lower-cased words in `text`."""
+
+    return set(TOKEN_RE.findall(text.lower()))
+
+
+class NoteIndex(object):
+    """An inverted index over the note files in one notes directory.
+
+    Notes are identified by their filename relative to the notes directory
+    (title plus extension). Each version of a note's file gets a new document
+    id, postings map each word to an array of the document ids that contain
+    it. When a note is modified or removed its old document id becomes dead,
+    dead ids are filtered out of lookups and periodically compacted away.
+
+    """
+    def __init__(self, path):
+        """Make a new, empty NoteIndex.
+
+        Arguments:
+        path -- the file that the index is saved to (string)
+
+        """
+        self.path = path
+        self.dirty = False
+        self._docs = {}  # filename -> (docid, mtime, size)
+        self._live = {}  # docid -> filename
+        self._postings = {}  # word -> array of docids
+        self._next_docid = 0
+        self._dead = 0
+        self._vocabulary = None  # All words joined by newlines, built lazily.
+
+    @classmethod
+    def load(cls, path):
+        """Return the NoteIndex saved at `path`, or a new empty one."""
+
+        index = cls(path)
+        state = notebook_module.load_cache(path)
+        if not isinstance(state, dict) or (
+                state.get("version") != INDEX_VERSION):
+            return index
+        index._docs = state["docs"]
+        index._postings = state["postings"]
+        index._next_docid = state["next_docid"]
+        index._dead = state["dead"]
+        for filename, doc in index._docs.items():
+            index._live[doc[0]] = filename
+        return index
+
+    def save(self):
+        """Save this index to its file, if it has changed."""
+
+        if self.dirty:
+            notebook_module.write_cache(self.dumps(), self.path)
+
+    def dumps(self):
+        """Return this index pickled, to be written to its file with
+        notebook.write_cache(), and mark it as saved."""
+
+        data = pickle.dumps({
+                "version": INDEX_VERSION,
+                "docs": self._docs,
+                "postings": self._postings,
+                "next_docid": self._next_docid,
+                "dead": self._dead,
+                }, pickle.HIGHEST_PROTOCOL)
+        self.dirty = False
+        return data
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, filename, mtime, size, text):
+        """Index `text` as the contents of the note file `filename`.
+
+        Replaces any text previously indexed for the same filename.
+
+        """
+        self.discard(filename)
+        docid = self._next_docid
+        self._next_docid += 1
+        self._docs[filename] = (docid, mtime, size)
+        self._live[docid] = filename
+        for word in tokenize(text):
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = array.array("l")
+                self._vocabulary = None
+            postings.append(docid)
+        self.dirty = True
+
+    def discard(self, filename):
+        """Remove the note file `filename` from the index, if it's there."""
+
+        doc = self._docs.pop(filename, None)
+        if doc is None:
+            return
+        del self._live[doc[0]]
+        self._dead += 1
+        self.dirty = True
+        if self._dead >= max(MIN_DEAD_TO_COMPACT, len(self._live)):
+            self.compact()
+
+    def compact(self):
+        """Remove dead document ids from the postings."""
+
+        live = self._live
+        for word, postings in list(self._postings.items()):
+            kept = array.array("l", [d for d in postings if d in live])
+            if kept:
+                self._postings[word] = kept
+            else:
+                del self._postings[word]
+        self._dead = 0
+        self._vocabulary = None
+        self.dirty = True
+
+    def is_current(self, filename, mtime, size):
+        """Return True if `filename` is indexed with this mtime and size."""
+
+        doc = self._docs.get(filename)
+        return doc is not None and doc[1] == mtime and doc[2] == size
+
+    def filenames(self):
+        """Return a list of the filenames of all the indexed notes."""
+
+        return list(self._docs)
+
+    def docids_containing(self, fragment):
+        """Return the set of document ids with a word containing `fragment`.
+
+        `fragment` must be lower case and contain only word characters. The
+        returned set may include dead document ids.
+
+        """
+        if self._vocabulary is None:
+            self._vocabulary = "\n".join(self._postings)
+        vocabulary = self._vocabulary
+        docids = set()
+        start = vocabulary.find(fragment)
+        while start != -1:
+            line_start = vocabulary.rfind("\n", 0, start) + 1
+            line_end = vocabulary.find("\n", start)
+            if line_end == -1:
+                line_end = len(vocabulary)
+            docids.update(self._postings[vocabulary[line_start:line_end]])
+            start = vocabulary.find(fragment, line_end)
+        return docids
+
+    def filenames_for(self, docids):
+        """Return the set of filenames of the live documents in `docids`."""
+
+        live = self._live
+        return set(live[d] for d in docids if d in live)
+
+
+class IndexedSearch(object):
+    """A search function that answers queries from a NoteIndex.
+
+    An IndexedSearch object can be passed as the search_function of a
+    PlainTextNoteBook. It keeps one NoteIndex per notes directory.
+
+    It may be called from several threads at once, e.g. by a background
+    search while the UI searches again after a note has been edited. Each
+    NoteIndex is only brought up to date and looked up by one thread at a
+    time.
+
+    Call close() when done with it, to save any changes that haven't been
+    saved yet.
+
+    """
+    # The index is looked up by notebook path, so it can't search arbitrary
+    # sequences of notes.
+    searches_subsets = False
+
+    def __init__(self, refresh_interval=None, save_delay=DEFAULT_SAVE_DELAY):
+        """Make a new IndexedSearch.
+
+        Keyword arguments:
+        refresh_interval -- how often (in seconds) to check all of the
+            notes' files for changes and update the index, at most. By
+            default they're only checked the first time the index is used,
+            after that the notebook's reports of changed notes are relied on
+            (float or None)
+        save_delay -- how long to wait after an index last changed before
+            saving it in the background, in seconds (float)
+
+        """
+        self.refresh_interval = refresh_interval
+        self.save_delay = save_delay
+        self._indexes = {}  # notes dir -> NoteIndex
+        self._refreshed = {}  # notes dir -> time of last refresh
+        self._changed = {}  # notes dir -> set of notes reported changed
+        self._changed_lock = threading.Lock()
+        self._index_locks = {}  # notes dir -> lock held while using its index
+        self._index_locks_lock = threading.Lock()
+        self._save_timers = {}  # notes dir -> threading.Timer
+        self._save_timers_lock = threading.Lock()
+        # Held while writing an index file, so that close() doesn't write
+        # one at the same time as a timer.
+        self._write_lock = threading.Lock()
+
+    def index_lock(self, notebook):
+        """Return the lock that serialises use of `notebook`'s NoteIndex.
+
+        Hold it while using the index returned by index(), the index isn't
+        safe to read while another thread updates it.
+
+        """
+        return self._index_lock(notebook.path)
+
+    def _index_lock(self, path):
+        with self._index_locks_lock:
+            lock = self._index_locks.get(path)
+            if lock is None:
+                lock = self._index_locks[path] = threading.RLock()
+        return lock
+
+    def _save_later(self, path):
+        """Save the index of the notes dir `path` in a background thread once
+        it's gone `save_delay` seconds without changing."""
+
+        with self._save_timers_lock:
+            timer = self._save_timers.get(path)
+            if timer is not None:
+                timer.cancel()
+            timer = self._save_timers[path] = threading.Timer(
+                    self.save_delay, self._save, (path,))
+            timer.daemon = True
+            timer.start()
+
+    def _save(self, path):
+        with self._write_lock:
+            # The index is pickled while holding its lock, which is quicker
+            # than writing it out, and written without.
+            with self._index_lock(path):
+                index = self._indexes.get(path)
+                if index is None or not index.dirty:
+                    return
+                data = index.dumps()
+            notebook_module.write_cache(data, index.path)
+
+    def close(self):
+        """Save the indexes that have changed since they were last saved."""
+
+        with self._save_timers_lock:
+            timers, self._save_timers = self._save_timers, {}
+        for timer in timers.values():
+            timer.cancel()
+        for path in list(self._indexes):
+            self._save(path)
+
+    def index(self, notebook):
+        """Return the up-to-date NoteIndex for `notebook`."""
+
+        with self.index_lock(notebook):
+            return self._up_to_date_index(notebook)
+
+    def _up_to_date_index(self, notebook):
+        index = self._indexes.get(notebook.path)
+        if index is None:
+            index = NoteIndex.load(
+                    notebook_module.sidecar_path(notebook.path, "tv2index"))
+            self._indexes[notebook.path] = index
+            self._changed[notebook.path] = set()
+            notebook.add_listener(
+                    lambda event, note: self._on_change(notebook.path, note))
+
+        with self._changed_lock:
+            changed = self._changed[notebook.path]
+            self._changed[notebook.path] = set()
+        was_dirty = index.dirty
+        if changed:
+            for note in changed:
+                if note in notebook:
+                    self.update(note, index)
+                else:
+                    index.discard(note.title + note.extension)
+
+        # While the notebook is still loading, notes missing from it may just
+        # not have been read yet, don't drop them from the index. The notes
+        # it loads aren't reported to listeners, so the index is refreshed
+        # once it has loaded.
+        now = time.time()
+        refreshed = self._refreshed.get(notebook.path)
+        if not getattr(notebook, "loading", False) and (
+                refreshed is None or (self.refresh_interval is not None
+                    and now - refreshed >= self.refresh_interval)):
+            self.refresh(notebook, index)
+            self._refreshed[notebook.path] = now
+        if index.dirty and (changed or not was_dirty):
+            self._save_later(notebook.path)
+        return index
+
+    def refresh(self, notebook, index):
+        """Bring `index` up to date with the note files in `notebook`.
+
+        Notes whose files have the same mtime and size as when they were
+        indexed are not read again.
+
+        """
+        seen = set()
+        updated = 0
+        for note in notebook:
+            if self.update(note, index):
+                updated += 1
+            seen.add(note.title + note.extension)
+        for filename in index.filenames():
+            if filename not in seen:
+                index.discard(filename)
+        if updated:
+            logger.debug("Indexed {0} new or modified notes in {1}".format(
+                updated, notebook.path))
+
+    def update(self, note, index):
+        """Re-index `note` in `index` if its file has changed.
+
+        Returns True if the note was (re-)indexed.
+
+        """
+        filename = note.title + note.extension
+        try:
+            stat = os.stat(note.abspath)
+        except OSError:
+            # The file has gone, leave it out of the index.
+            index.discard(filename)
+            return False
+        if index.is_current(filename, stat.st_mtime, stat.st_size):
+            return False
+        try:
+            contents = note.contents
+        except (IOError, OSError, UnicodeDecodeError) as e:
+            logger.error("Could not index {0}: {1}".format(note.abspath, e))
+            contents = ""
+        index.add(filename, stat.st_mtime, stat.st_size,
+                note.title + "\n" + contents)
+        return True
+
+    def _on_change(self, path, note):
+        # Called by the notebook, possibly from another thread.
+        with self._changed_lock:
+            self._changed[path].add(note)
+
+    def __call__(self, notebook, query):
+        """Return all notes in `notebook` that match `query`."""
+
+        search_words = query.strip().split()
+        if not search_words:
+            return list(notebook)
+
+        with self.index_lock(notebook):
+            index = self.index(notebook)
+
+            # Narrow the candidates down using the index. Words that aren't
+            # answered exactly by the index are checked against the notes
+            # later.
+            candidates = None
+            unverified_words = []
+            for search_word in search_words:
+                lowered = search_word.lower()
+                fragments = TOKEN_RE.findall(lowered)
+                if search_word != lowered or fragments != [lowered]:
+                    unverified_words.append(search_word)
+                for fragment in fragments:
+                    docids = index.docids_containing(fragment)
+                    if candidates is None:
+                        candidates = docids
+                    else:
+                        candidates &= docids
+                    if not candidates:
+                        return []
+
+            if candidates is None:
+                # None of the search words had any word characters in them.
+                filenames = None
+            else:
+                filenames = index.filenames_for(candidates)
+
+        matching_notes = []
+        for note in notebook:
+            if filenames is not None and (
+                    note.title + note.extension) not in filenames:
+                continue
+            if unverified_words and not notebook_module.note_matches(
+                    note, unverified_words):
+                continue
+            matching_notes.append(note)
+        return matching_notes
@@ -0,0 +1,153 @@
+"""A byte-level search function for notebooks with large note files.
+
+brute_force_search decodes every note file into a string and makes a
+lower-cased copy of it for case-insensitive search. For multi-megabyte notes
+(logs, exported transcripts...) that is a lot of allocating and copying per
+search.
+
+mmap_search matches search words against the raw bytes of the note files
+instead: large files are memory-mapped, small ones are read into a single
+bytes object, and nothing is decoded. ASCII search words are matched
+directly against the bytes. For case-insensitive words the file is
+lower-cased with bytes.lower() a chunk at a time, so only one chunk's worth
+of memory is used however big the file is, and each chunk is lower-cased
+once for all of the query's case-insensitive words. Only search words with
+non-ASCII characters in them fall back to decoding the note's contents.
+
+It has the same semantics as brute_force_search (lower case words match
+case-insensitively, other words case-sensitively) for notes saved as UTF-8 or
+any other ASCII-compatible encoding. Notes that start with a UTF-16 or UTF-32
+byte order mark are decoded and searched like brute_force_search does.
+
+    notebook = PlainTextNoteBook(path, extension, extensions,
+            search_function=mmap_search)
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+import mmap
+import os
+
+from . import notebook as notebook_module
+
+
+# Files smaller than this are read rather than memory-mapped, in bytes.
+MMAP_THRESHOLD = 64 * 1024
+
+# How many bytes of a file to lower-case at a time when searching it for
+# case-insensitive words.
+CHUNK_SIZE = 64 * 1024
+
+
+def _ascii_bytes(search_word):
+    """Return `search_word` encoded as ASCII, or None if it can't be matched
+    against bytes directly because it contains non-ASCII characters."""
+
+    try:
+        return search_word.encode("ascii")
+    except UnicodeEncodeError:
+        return None
+
+
+def _contains_lowercase(buf, words):
+    """Return True if `buf` contains all of `words`, ignoring ASCII case.
+
+    `buf` is a bytes-like object (bytes or mmap) and `words` are lower-case
+    ASCII bytes. `buf` is lower-cased CHUNK_SIZE bytes at a time, and each
+    chunk overlaps the next by one byte less than the longest word so that
+    words spanning two chunks are found. Stops as soon as all the words have
+    been found.
+
+    """
+    remaining = set(words)
+    if not remaining:
+        return True
+    overlap = max(len(word) for word in remaining) - 1
+    start = 0
+    while True:
+        end = start + CHUNK_SIZE + overlap
+        chunk = buf[start:end].lower()
+        remaining = set(word for word in remaining if word not in chunk)
+        if not remaining:
+            return True
+        if end >= len(buf):
+            return False
+        start += CHUNK_SIZE
+
+
+def _in_title(note, search_word):
+    if search_word.islower():
+        return search_word in note.title.lower()
+    return search_word in note.title
+
+
+def _file_matches(note, search_words):
+    """Return True if the note's file contains all of `search_words`."""
+
+    case_sensitive = []
+    case_insensitive = []
+    non_ascii = []
+    for search_word in search_words:
+        word_bytes = _ascii_bytes(search_word)
+        if word_bytes is None:
+            non_ascii.append(search_word)
+        elif search_word.islower():
+            case_insensitive.append(word_bytes)
+        else:
+            case_sensitive.append(word_bytes)
+
+    with open(note.abspath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            buf = b""
+        elif size < MMAP_THRESHOLD:
+            buf = f.read()
+        else:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if notebook_module.bom_encoding(buf[:4]) in ("utf-16", "utf-32"):
+                # ASCII characters aren't single bytes in these encodings.
+                return notebook_module.note_matches(note, search_words)
+            for word_bytes in case_sensitive:
+                if buf.find(word_bytes) == -1:
+                    return False
+            if not _contains_lowercase(buf, case_insensitive):
+                return False
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+    # Fall back on decoding the note's contents, only once the cheaper
+    # tests have passed.
+    return not non_ascii or notebook_module.note_matches(note, non_ascii)
+
+
+def mmap_search(notebook, query):
+    """Return all notes in `notebook` that match `query`.
+
+    Arguments:
+
+    notebook - the notebook to search (NoteBook, or any other sequence of
+        Notes)
+
+    query - the query to search for (string)
+
+    """
+    search_words = query.strip().split()
+    matching_notes = []
+    for note in notebook:
+        # Words in the note's title don't need to be searched for in the file.
+        remaining_words = [search_word for search_word in search_words
+                if not _in_title(note, search_word)]
+        if remaining_words:
+            try:
+                if not _file_matches(note, remaining_words):
+                    continue
+            except (IOError, OSError, ValueError) as e:
+                logger.error("Could not search {0}: {1}".format(
+                    note.abspath, e))
+                continue
+        matching_notes.append(note)
+    return matching_notes
+
+# Note files are read directly, not through the notebook's ContentCache.
+mmap_search.reads_content_cache = False
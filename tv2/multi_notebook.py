@@ -0,0 +1,347 @@
+"""A notebook made of several notes directories, searched as one.
+
+    notebook = MultiNoteBook(["~/Notes", "~/Work", "/mnt/archive"],
+            extension, extensions)
+    matching_notes = notebook.search(query)
+
+Each notes directory gets its own notebook (a PlainTextNoteBook, or any
+drop-in replacement such as SQLiteNoteBook), with its own manifest, search
+history and, for search functions that keep one, index. MultiNoteBook
+implements the same NoteBook interface on top of them: the directories are
+read concurrently, and each query is searched in every notebook at once, by
+a thread per notebook, with the results merged. New notes go in the first
+directory, the primary one.
+
+Results are merged as each notebook's search finishes (see iter_search()),
+so a slow notebook, e.g. one on a network filesystem, doesn't hold up the
+results of the others. Sorted results are merged with heapq.merge() from
+each notebook's own ordering, ranked ones by their scores (see
+ranking.merge()).
+
+"""
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import logging
+logger = logging.getLogger(__name__)
+import queue
+import threading
+
+from . import notebook as notebook_module
+from . import ranking
+
+
+def make_notebook(notes_dirs, extension, extensions,
+        notebook_class=notebook_module.PlainTextNoteBook, **kwargs):
+    """Return a notebook for one or more notes directories.
+
+    Returns a `notebook_class` notebook if there's only one directory,
+    otherwise a MultiNoteBook of them. Any other arguments are passed on to
+    the notebook.
+
+    Arguments:
+    notes_dirs -- the notes directory, or a list of notes directories with
+        the primary one first (string or list of strings)
+
+    """
+    if isinstance(notes_dirs, str):
+        notes_dirs = [notes_dirs]
+    if len(notes_dirs) == 1:
+        return notebook_class(notes_dirs[0], extension, extensions, **kwargs)
+    return MultiNoteBook(notes_dirs, extension, extensions,
+            notebook_class=notebook_class, **kwargs)
+
+
+class MultiNoteBook(object):
+    """A NoteBook of the notes in several notes directories."""
+
+    def __init__(self, paths, extension, extensions,
+            notebook_class=notebook_module.PlainTextNoteBook, load=True,
+            **kwargs):
+        """Make a new MultiNoteBook for the given paths.
+
+        Takes the same arguments as PlainTextNoteBook, except for taking a
+        list of paths. The notes in all of the directories share one
+        ContentCache, of the given cache_size.
+
+        Raises NewNoteBookError if no paths are given, or if making one of
+        the notebooks fails.
+
+        Arguments:
+        paths -- absolute paths to the notes directories, the primary one,
+            where new notes are added, first (list of strings)
+        notebook_class -- the NoteBook class to use for each directory
+        load -- whether to read the notes directories now, if False the
+            notebook starts out empty and load() or load_batches() must be
+            called to read them (bool)
+
+        """
+        if not paths:
+            raise notebook_module.NewNoteBookError(
+                    "No notes directories given")
+        self.notebooks = [notebook_class(path, extension, extensions,
+                load=False, **kwargs) for path in paths]
+        primary = self.notebooks[0]
+        self.cache = primary.cache
+        for notebook in self.notebooks[1:]:
+            notebook.cache = self.cache
+        self.extension = primary.extension
+        self.extensions = primary.extensions
+        self.exclude = primary.exclude
+        self.search_function = primary.search_function
+        # True while load_batches() is reading the notes directories.
+        self.loading = False
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.notebooks))
+        if load:
+            self.load()
+
+    @property
+    def path(self):
+        """The primary notes directory."""
+
+        return self.notebooks[0].path
+
+    @property
+    def paths(self):
+        return [notebook.path for notebook in self.notebooks]
+
+    def close(self):
+        """Stop the search threads and close the notebooks."""
+
+        self._pool.shutdown(wait=False)
+        for notebook in self.notebooks:
+            if hasattr(notebook, "close"):
+                notebook.close()
+
+    def load(self):
+        """Read the notes directories into this notebook."""
+
+        for notes in self.load_batches():
+            pass
+
+    def load_batches(self):
+        """Read the notes directories, yielding each batch of new Notes as
+        it's added.
+
+        Each notebook is loaded by its own thread (see
+        PlainTextNoteBook.load_batches()) and batches are yielded as they
+        arrive from any of them, so a slow directory doesn't hold up the
+        rest. A notebook that fails to load is logged and left out.
+
+        """
+        self.loading = True
+        batches = queue.Queue()
+
+        def load(notebook):
+            try:
+                for notes in notebook.load_batches():
+                    batches.put(notes)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                batches.put(None)
+
+        for i, notebook in enumerate(self.notebooks):
+            thread = threading.Thread(target=load, args=(notebook,),
+                    name="tv2-load-{0}".format(i))
+            thread.daemon = True
+            thread.start()
+        try:
+            remaining = len(self.notebooks)
+            while remaining:
+                notes = batches.get()
+                if notes is None:
+                    remaining -= 1
+                else:
+                    yield notes
+        finally:
+            self.loading = False
+
+    def search_each(self, query, cancelled=None):
+        """Search each notebook for `query` at once.
+
+        Yields a (notebook, matching notes) tuple for each notebook, in the
+        order their searches finish.
+
+        Raises SearchCancelledError if `cancelled` returns True before the
+        searches finish, see PlainTextNoteBook.search().
+
+        """
+        if len(self.notebooks) == 1:
+            notebook = self.notebooks[0]
+            yield notebook, notebook.search(query, cancelled=cancelled)
+            return
+        futures = dict((self._pool.submit(notebook.search, query, cancelled),
+                notebook) for notebook in self.notebooks)
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def iter_search(self, query, cancelled=None):
+        """Yield the notes that match `query` found so far, each time
+        another notebook has been searched.
+
+        The last notes yielded are all of the matching notes, the same as
+        search() returns.
+
+        """
+        results = {}  # notebook id -> matching notes
+        for notebook, matching_notes in self.search_each(query, cancelled):
+            results[id(notebook)] = matching_notes
+            yield self._merge([results[id(notebook)]
+                    for notebook in self.notebooks
+                    if id(notebook) in results])
+
+    def search(self, query, cancelled=None):
+        """Return a sequence of Notes that match the given query.
+
+        The notebooks are searched at once, see search_each(). This method
+        may be called from a background thread.
+
+        """
+        results = dict((id(notebook), matching_notes)
+                for notebook, matching_notes in self.search_each(
+                    query, cancelled))
+        return self._merge([results[id(notebook)]
+                for notebook in self.notebooks])
+
+    def _merge(self, results):
+        if all(getattr(matching_notes, "ranked", False)
+                for matching_notes in results):
+            return ranking.merge(results,
+                    max(matching_notes.k for matching_notes in results))
+        notes = []
+        for matching_notes in results:
+            notes.extend(getattr(matching_notes, "matches", matching_notes))
+        return notes
+
+    def clear_search_history(self):
+        for notebook in self.notebooks:
+            notebook.clear_search_history()
+
+    def sort(self, notes=None, order="mtime"):
+        """Return a list of the given Notes, sorted.
+
+        Each notebook sorts its own notes (see PlainTextNoteBook.sort()) and
+        the sorted notes are merged.
+
+        """
+        if notes is None:
+            lists = [notebook.sort(order=order) for notebook in self.notebooks]
+        else:
+            notes_by_notebook = collections.defaultdict(list)
+            for note in notes:
+                notes_by_notebook[id(note.notebook)].append(note)
+            lists = [notebook.sort(notes_by_notebook[id(notebook)], order)
+                    for notebook in self.notebooks
+                    if id(notebook) in notes_by_notebook]
+        return self._merge_sorted(lists, order)
+
+    def notes_with_title_prefix(self, prefix):
+        """Return the Notes whose titles begin with `prefix`, ignoring case,
+        in title order."""
+
+        return self._merge_sorted([notebook.notes_with_title_prefix(prefix)
+                for notebook in self.notebooks], "title")
+
+    def _merge_sorted(self, lists, order):
+        if len(lists) == 1:
+            return lists[0]
+        return list(heapq.merge(*lists,
+                key=lambda note: notebook_module._sort_key(note, order),
+                reverse=order != "title"))
+
+    def add_new(self, title, extension=None):
+        """Create a new Note in the primary notes directory.
+
+        See PlainTextNoteBook.add_new().
+
+        """
+        return self.notebooks[0].add_new(title, extension)
+
+    def get_note(self, title, extension=None):
+        """Return the Note with the given title and extension, or None.
+
+        The primary notebook is looked in first.
+
+        """
+        for notebook in self.notebooks:
+            note = notebook.get_note(title, extension)
+            if note is not None:
+                return note
+        return None
+
+    def note_changed(self, note):
+        """Tell this NoteBook that a Note's file has been modified."""
+
+        notebook = self._notebook_of(note)
+        if notebook is not None:
+            notebook.note_changed(note)
+
+    def forget(self, note):
+        """Remove a Note whose file has gone from this NoteBook."""
+
+        notebook = self._notebook_of(note)
+        if notebook is not None:
+            notebook.forget(note)
+
+    def forget_notes(self, notes):
+        """Remove several Notes whose files have gone from this NoteBook, see
+        PlainTextNoteBook.forget_notes()."""
+
+        notes_by_notebook = collections.defaultdict(list)
+        for note in notes:
+            notebook = self._notebook_of(note)
+            if notebook is not None:
+                notes_by_notebook[id(notebook)].append(note)
+        for notebook in self.notebooks:
+            if id(notebook) in notes_by_notebook:
+                notebook.forget_notes(notes_by_notebook[id(notebook)])
+
+    def _notebook_of(self, note):
+        for notebook in self.notebooks:
+            if note in notebook:
+                return notebook
+        return None
+
+    def add_listener(self, listener):
+        """Call `listener` whenever a Note is added, modified or removed in
+        any of the notebooks, see PlainTextNoteBook.add_listener()."""
+
+        for notebook in self.notebooks:
+            notebook.add_listener(listener)
+
+    def remove_listener(self, listener):
+        for notebook in self.notebooks:
+            notebook.remove_listener(listener)
+
+    def __len__(self):
+        return sum(len(notebook) for notebook in self.notebooks)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index >= 0:
+            for notebook in self.notebooks:
+                if index < len(notebook):
+                    return notebook[index]
+                index -= len(notebook)
+        raise IndexError("notebook index out of range")
+
+    def __delitem__(self, index):
+        raise NotImplementedError
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.notebooks)
+
+    def __reversed__(self):
+        return itertools.chain.from_iterable(
+                reversed(notebook) for notebook in reversed(self.notebooks))
+
+    def __contains__(self, note):
+        return self._notebook_of(note) is not None
@@ -51,11 +51,36 @@ notes:
 This module provides a simple brute force full text search implementation.
 Other modules could provide better search functions that could be plugged in.
 
+A search function is called as search_function(notes, query) and returns a
+list of the notes that match. `notes` is normally the NoteBook itself, but
+when a query only adds to the previous one (e.g. the user typed one more
+character) PlainTextNoteBook passes the list of notes that matched the previous
+query instead, so only those are searched again. Search functions that need a
+whole NoteBook can opt out of this by having a false `searches_subsets`
+attribute.
+
+A search function may also return its results already in order, in a
+read-only sequence with a true `ranked` attribute and a `matches` attribute
+holding all the matching notes in any order (see ranking.RankedResults).
+Such results are remembered as they are rather than copied, and narrower
+queries search their `matches`.
+
+Search functions that don't read notes through the notebook's ContentCache
+(e.g. because they read the note files some other way) have a false
+`reads_content_cache` attribute, so that the cache's read counts aren't
+taken for theirs.
+
 """
+import bisect
+import codecs
+import collections
+import concurrent.futures
 import logging
 logger = logging.getLogger(__name__)
 import os
+import pickle
 import sys
+import threading
 
 import chardet
 
@@ -101,6 +126,11 @@ class InvalidNoteTitleError(NewNoteError):
     pass
 
 
+class SearchCancelledError(Error):
+    """Exception raised when a search is cancelled before it finishes."""
+    pass
+
+
 class DelNoteError(Error):
     """Exception raised if removing a Note from a NoteBook fails.
 
@@ -112,10 +142,255 @@ class DelNoteError(Error):
         return repr(self.value)
 
 
+# Bump this when the format of saved manifests changes, old ones are ignored.
+MANIFEST_VERSION = 2
+
+# How many threads to list notes directories with, at most.
+DEFAULT_SCAN_THREADS = 8
+
+# How many recent searches a PlainTextNoteBook remembers.
+SEARCH_HISTORY_SIZE = 32
+
+# The default memory budget for a notebook's ContentCache, in bytes.
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+# The orders that PlainTextNoteBook.sort() can put notes in.
+SORT_ORDERS = ("mtime", "ctime", "title")
+
+# PlainTextNoteBook.sort() picks the notes out of the notebook's ordering of
+# all its notes, rather than sorting them, when there are at least this many
+# notes to sort per note in the notebook.
+SORT_BY_FILTERING_RATIO = 0.125
+
+# PlainTextNoteBook.forget_notes() filters the notebook's list of notes and
+# its orderings, rather than removing the notes one by one, when at least
+# this many notes are forgotten per note in the notebook.
+FORGET_BY_FILTERING_RATIO = 1.0 / 256
+
+# How many bytes of a note file that isn't UTF-8 chardet looks at to guess
+# its encoding.
+DETECTION_SIZE = 64 * 1024
+
+# The encoding to use when chardet can't tell, it can decode any bytes.
+FALLBACK_ENCODING = "latin-1"
+
+# Byte order marks and the encodings they mean. The UTF-32 little-endian BOM
+# starts with the UTF-16 one, so it must come first.
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+    )
+
+
+def bom_encoding(data):
+    """Return the encoding given by the byte order mark at the start of
+    `data` (bytes), or None if there isn't one."""
+
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            return encoding
+    return None
+
+
+def detect_encoding(data, error_offset=0):
+    """Guess the encoding of `data`, bytes that aren't valid UTF-8.
+
+    Only DETECTION_SIZE bytes are given to chardet, starting a little before
+    `error_offset` (where the first byte that isn't valid UTF-8 is) so that
+    chardet sees the non-ASCII text rather than a long ASCII prefix.
+
+    """
+    start = max(0, min(error_offset - DETECTION_SIZE // 2,
+        len(data) - DETECTION_SIZE))
+    encoding = chardet.detect(data[start:start + DETECTION_SIZE])["encoding"]
+    if not encoding or encoding.lower() == "ascii":
+        return FALLBACK_ENCODING
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return FALLBACK_ENCODING
+    return encoding
+
+
+def decode(data, encoding=None):
+    """Decode the contents of a note file.
+
+    Returns a (text, encoding) tuple, where `encoding` is the encoding that
+    was used. The encoding given by a byte order mark is used if there is
+    one, then UTF-8 is tried, and if the file isn't valid UTF-8 chardet
+    guesses (see detect_encoding()). Bytes that aren't valid in the guessed
+    encoding are replaced, so this never raises UnicodeDecodeError.
+
+    Line endings are turned into newlines, as when reading a file in text
+    mode.
+
+    Arguments:
+    data -- the contents of the file (bytes)
+    encoding -- the encoding to try first, e.g. the one that worked the last
+        time the file was read (string)
+
+    """
+    text = None
+    if encoding is not None:
+        try:
+            text = data.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            encoding = None
+    if text is None:
+        encoding = bom_encoding(data)
+        if encoding is None:
+            try:
+                text = data.decode("utf-8")
+                encoding = "utf-8"
+            except UnicodeDecodeError as e:
+                encoding = detect_encoding(data, e.start)
+        if text is None:
+            text = data.decode(encoding, "replace")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text, encoding
+
+
+class ContentCache(object):
+    """A least-recently-used cache of the contents of note files.
+
+    Each entry holds a file's decoded contents and a lower-cased copy (for
+    case-insensitive search), and is only used while the file's mtime and size
+    are unchanged. When the total memory used by the cached strings goes over
+    the budget the least recently used entries are evicted.
+
+    Files are decoded with decode(). The encoding of each file that isn't
+    UTF-8 is remembered, even after its contents have been evicted, until the
+    file's mtime or size changes, so it's only detected once.
+
+    The cache counts the files it has had to read (files_read) and their
+    total size in bytes (bytes_read).
+
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        """Make a new, empty ContentCache.
+
+        Keyword arguments:
+        max_size -- the memory budget, in bytes (int, 0 disables caching)
+
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.files_read = 0
+        self.bytes_read = 0
+        self._entries = collections.OrderedDict()
+        self._encodings = {}  # abspath -> (mtime and size, encoding)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, abspath):
+        """Return the contents and lower-cased contents of a file.
+
+        Returns a (contents, lowercase_contents) tuple of strings, from the
+        cache if the cached copy is still fresh, otherwise read from disk.
+
+        Raises IOError or OSError if the file can't be read.
+
+        """
+        stat = os.stat(abspath)
+        freshness = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.pop(abspath, None)
+            if entry is not None:
+                if entry[0] == freshness:
+                    # Re-insert the entry to mark it most recently used.
+                    self._entries[abspath] = entry
+                    return entry[1], entry[2]
+                self.size -= entry[3]
+
+        contents = self.read(abspath, freshness)
+        lowercase_contents = contents.lower()
+
+        nbytes = sys.getsizeof(contents) + sys.getsizeof(lowercase_contents)
+        with self._lock:
+            self.files_read += 1
+            self.bytes_read += stat.st_size
+        if nbytes <= self.max_size:
+            with self._lock:
+                old_entry = self._entries.pop(abspath, None)
+                if old_entry is not None:
+                    self.size -= old_entry[3]
+                self._entries[abspath] = (
+                        freshness, contents, lowercase_contents, nbytes)
+                self.size += nbytes
+                while self.size > self.max_size:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= evicted[3]
+        return contents, lowercase_contents
+
+    def read(self, abspath, freshness=None):
+        """Read and decode a file, without caching its contents.
+
+        The file's remembered encoding is tried first, if it hasn't changed
+        since, otherwise the encoding is detected and remembered.
+
+        Raises IOError or OSError if the file can't be read.
+
+        Arguments:
+        abspath -- the absolute path to the file (string)
+        freshness -- the file's (st_mtime_ns, st_size), if it has just been
+            stat-ed (tuple)
+
+        """
+        with open(abspath, "rb") as f:
+            if freshness is None:
+                stat = os.fstat(f.fileno())
+                freshness = (stat.st_mtime_ns, stat.st_size)
+            data = f.read()
+        with self._lock:
+            entry = self._encodings.get(abspath)
+        encoding = None
+        if entry is not None and entry[0] == freshness:
+            encoding = entry[1]
+        contents, encoding = decode(data, encoding)
+        with self._lock:
+            # UTF-8 is always tried first, it doesn't need remembering.
+            if encoding != "utf-8":
+                self._encodings[abspath] = (freshness, encoding)
+            elif entry is not None:
+                self._encodings.pop(abspath, None)
+        return contents
+
+    def discard(self, abspath):
+        """Remove the given file's entry from the cache, if there is one."""
+
+        with self._lock:
+            entry = self._entries.pop(abspath, None)
+            if entry is not None:
+                self.size -= entry[3]
+            self._encodings.pop(abspath, None)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+
+        with self._lock:
+            self._entries.clear()
+            self._encodings.clear()
+            self.size = 0
+
+
 class PlainTextNote(object):
-    """A note, stored as a plain text file on disk."""
+    """A note, stored as a plain text file on disk.
 
-    def __init__(self, title, notebook, extension):
+    A notebook may hold a million PlainTextNotes, so they're kept small: they
+    have no __dict__, and only the title is stored, the path of the note's
+    file is worked out from the notebook's path when it's needed. Notes with
+    the same extension share its string.
+
+    """
+    __slots__ = ("_title", "_notebook", "_extension", "_mtime", "_ctime")
+
+    def __init__(self, title, notebook, extension, create=True, times=None):
         """Initialise a new PlainTextNote.
 
         A path for the note's file will be generated from the NoteBook's
@@ -123,9 +398,12 @@ class PlainTextNote(object):
 
         If a file already exists at the given path, it will be used as the
         note's file. If not, an empty file will be created (parent directories
-        will be created also, if necessary).
+        will be created also, if necessary). If `create` is False the file is
+        known to exist already (e.g. it was just found by scanning the notes
+        directory) and isn't touched at all.
 
-        The modified time of the note will be read from the mtime of the file.
+        The modified time of the note will be read from the mtime of the file,
+        unless `times` are given.
 
         Raises NewNoteError if something goes wrong when creating or reading
         the note file.
@@ -135,13 +413,23 @@ class PlainTextNote(object):
         notebook -- the PlainTextNoteBook this PlainTextNote will belong to
         extension -- the filename extension to use (string, should start with
             a dot e.g. ".txt")
+        create -- whether to create the note's file if it doesn't exist
+            (bool)
+        times -- the file's (mtime, ctime), if it has just been stat-ed
+            (tuple of floats)
 
         """
         self._title = title
         self._notebook = notebook
-        self._extension = extension
-        self._filename = self.title + self._extension
-        self._abspath = os.path.join(self._notebook.path, self._filename)
+        self._extension = sys.intern(extension)
+        if times is None:
+            # Read from the file when first needed.
+            self._mtime = self._ctime = None
+        else:
+            self._mtime, self._ctime = times
+
+        if not create:
+            return
 
         # Create the file's parent directories (including note directory
         # subdirs) if they don't exist.
@@ -155,7 +443,8 @@ class PlainTextNote(object):
                         "{0} could not be created: {1}".format(directory, e))
 
         # Create an empty file if the file doesn't exist.
-        open(self.abspath, 'a')
+        with open(self.abspath, 'a'):
+            pass
 
     @property
     def title(self):
@@ -170,27 +459,418 @@ class PlainTextNote(object):
     def extension(self):
         return self._extension
 
+    @property
+    def notebook(self):
+        """The PlainTextNoteBook this note belongs to."""
+
+        return self._notebook
+
     @property
     def contents(self):
-        contents = open(self.abspath, "r").read()
-        if contents is None:
-            logger.error(
-                "Could not decode file contents: {0}".format(self.abspath))
-            return ""
-        else:
-            return contents
+        return self._notebook.cache.get(self.abspath)[0]
+
+    @property
+    def lowercase_contents(self):
+        """The note's contents, lower-cased for case-insensitive search."""
+
+        return self._notebook.cache.get(self.abspath)[1]
 
     @property
     def mtime(self):
-        return os.path.getmtime(self.abspath)
+        """The modification time of the note's file.
+
+        The file is only stat-ed the first time this (or ctime) is used. After
+        that the time is kept up to date by the notebook, which re-reads it
+        when it's told the note has changed (see
+        PlainTextNoteBook.note_changed()).
+
+        """
+        if self._mtime is None:
+            self._read_times()
+        return self._mtime
+
+    @property
+    def ctime(self):
+        """The creation time of the note's file, where the platform records
+        it, otherwise the time of the file's last status change.
+
+        Cached like mtime.
+
+        """
+        if self._ctime is None:
+            self._read_times()
+        return self._ctime
+
+    @property
+    def cached_mtime(self):
+        """The note's mtime if it has been read already, otherwise None.
+
+        Unlike mtime this never stats the file or changes the note, so it can
+        be used from another thread.
+
+        """
+        return self._mtime
+
+    def _read_times(self):
+        try:
+            stat = os.stat(self.abspath)
+        except OSError:
+            # The file has gone, the notebook will hear about it.
+            self._mtime = self._ctime = 0.0
+            return
+        # Worked out from st_mtime_ns like scan_notes_dir() does, so that
+        # times from either agree exactly.
+        self._mtime = stat.st_mtime_ns / 1e9
+        self._ctime = getattr(stat, "st_birthtime", stat.st_ctime)
 
     @property
     def abspath(self):
-        return self._abspath
+        return self._notebook.path_prefix + self._title + self._extension
 
     def __eq__(self, other):
+        if isinstance(other, PlainTextNote):
+            # Compare without making either note's abspath.
+            return (self._title == other._title
+                    and self._extension == other._extension
+                    and self._notebook.path == other._notebook.path)
         return getattr(other, 'abspath', None) == self.abspath
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._title, self._extension))
+
+
+def sidecar_path(path, suffix):
+    """Return the path of a hidden file that lives beside directory `path`.
+
+    For example sidecar_path("~/Notes", "tv2index") returns
+    "/home/user/.Notes.tv2index". Used for caches that must not be picked up
+    as notes or synced along with the notes themselves.
+
+    """
+    path = os.path.abspath(os.path.expanduser(path)).rstrip(os.sep)
+    head, tail = os.path.split(path)
+    return os.path.join(head, ".{0}.{1}".format(tail, suffix))
+
+
+def load_cache(path):
+    """Return the object pickled in the cache file at `path`, or None.
+
+    Missing, unreadable or corrupt cache files are not errors, they just
+    mean the cache has to be rebuilt.
+
+    """
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError, ValueError) as e:
+        if os.path.exists(path):
+            logger.warning("Ignoring unreadable cache {0}: {1}".format(
+                path, e))
+        return None
+
+
+def save_cache(obj, path):
+    """Pickle `obj` to the cache file at `path`, atomically.
+
+    Failing to write a cache is logged but not raised, the app works without
+    it.
+
+    """
+    try:
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    except pickle.PicklingError as e:
+        logger.error("Could not write cache {0}: {1}".format(path, e))
+        return
+    write_cache(data, path)
+
+
+def write_cache(data, path):
+    """Write already pickled `data` (bytes) to the cache file at `path`,
+    atomically, see save_cache()."""
+
+    tmp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(),
+            threading.current_thread().ident)
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        logger.error("Could not write cache {0}: {1}".format(path, e))
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def is_note_filename(name, extensions, exclude=()):
+    """Return True if a file called `name` should be read as a note.
+
+    Hidden files, backup files, files whose names are in `exclude` and files
+    without one of the given `extensions` aren't notes.
+
+    """
+    if name in exclude:
+        return False
+
+    # Ignore hidden and backup files.
+    if name.startswith('.') or name.endswith('~'):
+        return False
+
+    return os.path.splitext(name)[1] in extensions
+
+
+def _scan_notes_subdir(path, reldir, extensions, exclude, record=None,
+        with_stat=False):
+    """Scan one directory for scan_notes_dir().
+
+    Returns a (mtime, subdirs, notes) record for the directory: its mtime in
+    nanoseconds, the names of its subdirectories to scan next, and a list of
+    (title, extension) tuples for its note files, or (title, extension,
+    mtime, size, ctime) tuples if `with_stat` is True, with the file's mtime
+    in nanoseconds and its ctime as PlainTextNote.ctime gives it. Returns
+    None if the directory can't be read.
+
+    If `record` is given and the directory's mtime hasn't changed since it
+    was made, then no files have been added to or removed from the directory
+    and `record` is returned as it is, without listing the directory.
+
+    Otherwise the directory is listed using the file type information that
+    os.scandir() gets along with the listing, so no file in the directory is
+    opened, and files are only stat-ed if `with_stat` is True.
+
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError as e:
+        logger.error("Could not read directory {0}: {1}".format(path, e))
+        return None
+    if record is not None and record[0] == mtime:
+        return record
+
+    notes = []
+    subdirs = []
+    try:
+        entries = os.scandir(path)
+    except OSError as e:
+        logger.error("Could not read directory {0}: {1}".format(path, e))
+        return None
+    with entries:
+        for entry in entries:
+            name = entry.name
+
+            # Ignore anything listed in our 'exclude' list.
+            if name in exclude:
+                continue
+
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # Like os.walk(), don't follow symlinks to directories.
+                if not entry.is_symlink():
+                    subdirs.append(name)
+                continue
+
+            if not is_note_filename(name, extensions, exclude):
+                continue
+
+            title, ext = os.path.splitext(name)
+            title = os.path.join(reldir, title)
+            if with_stat:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # The file has gone since we listed the directory.
+                    continue
+                notes.append((title, ext, stat.st_mtime_ns, stat.st_size,
+                        getattr(stat, "st_birthtime", stat.st_ctime)))
+            else:
+                notes.append((title, ext))
+    return (mtime, subdirs, notes)
+
+
+def scan_notes_dir(path, extensions, exclude=(),
+        threads=DEFAULT_SCAN_THREADS, manifest=None, with_times=False):
+    """Find the note files in a notes directory and its subdirectories.
+
+    Yields a list of (title, extension) tuples for each directory that
+    contains notes, in no particular order. Titles are relative to `path` and
+    don't include the extension, like PlainTextNote titles.
+
+    Subdirectories are listed concurrently by a pool of threads, which helps a
+    lot when the notes directory is on a network filesystem.
+
+    If a `manifest` dict is given it is used as a record of the previous scan:
+    directories whose mtime hasn't changed since then aren't listed again.
+    Once all the directories have been scanned `manifest` is updated in place
+    to record this scan, including the mtime, size and ctime of each note
+    file. See PlainTextNoteBook for how manifests are saved between runs.
+
+    If `with_times` is True, (title, extension, mtime, ctime) tuples are
+    yielded instead, with the times of the note files that were stat-ed by
+    this scan (those in directories that were listed again, when a
+    `manifest` is given), to save stat-ing them again. The times are None
+    for the other notes: the times in the manifest may be out of date,
+    because modifying a file doesn't change its directory's mtime.
+
+    Arguments:
+    path -- absolute path to the notes directory (string)
+    extensions -- the filename extensions of note files (list of strings,
+        each starting with a dot)
+    exclude -- file and directory names to skip (list of strings)
+    threads -- the maximum number of threads to use (int)
+    manifest -- the record of the previous scan, a dict mapping each
+        directory's path relative to `path` to the record returned for it by
+        _scan_notes_subdir() (dict)
+    with_times -- whether to yield the times of the note files (bool)
+
+    """
+    extensions = frozenset(extensions)
+    exclude = frozenset(exclude)
+    with_stat = manifest is not None
+    records = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, threads)) as pool:
+        pending = {}
+
+        def scan(reldir):
+            record = None if manifest is None else manifest.get(reldir)
+            future = pool.submit(_scan_notes_subdir,
+                    os.path.join(path, reldir), reldir, extensions, exclude,
+                    record, with_stat)
+            pending[future] = reldir
+
+        scan("")
+        while pending:
+            done, _ = concurrent.futures.wait(pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                reldir = pending.pop(future)
+                record = future.result()
+                if record is None:
+                    continue
+                records[reldir] = record
+                mtime, subdirs, notes = record
+                for name in subdirs:
+                    scan(os.path.join(reldir, name))
+                if not notes:
+                    continue
+                if not with_times:
+                    notes = [note[:2] for note in notes]
+                elif with_stat and record is not manifest.get(reldir):
+                    notes = [(title, extension, note_mtime / 1e9, ctime)
+                            for title, extension, note_mtime, size, ctime
+                            in notes]
+                else:
+                    notes = [note[:2] + (None, None) for note in notes]
+                yield notes
+
+    if manifest is not None:
+        manifest.clear()
+        manifest.update(records)
+
+
+def note_matches(note, search_words):
+    """Return True if `note` contains all of `search_words`.
+
+    A search word matches if it occurs in the note's title or contents. Words
+    that are all lower case are matched case-insensitively, any other word is
+    matched case-sensitively.
+
+    A note whose file has gone or can't be read (e.g. it was deleted during a
+    search) doesn't match, like in mmap_search and ProcessPoolSearch.
+
+    """
+    # The note's contents are only read if a word isn't in the title, and at
+    # most once.
+    contents = None
+    lowercase_contents = None
+    try:
+        for search_word in search_words:
+            if search_word.islower():
+                # Search for word case-insensitively.
+                if search_word in note.title.lower():
+                    continue
+                if lowercase_contents is None:
+                    lowercase_contents = note.lowercase_contents
+                if search_word not in lowercase_contents:
+                    return False
+            else:
+                # Search for word case-sensitively.
+                if search_word in note.title:
+                    continue
+                if contents is None:
+                    contents = note.contents
+                if search_word not in contents:
+                    return False
+    except (IOError, OSError, UnicodeDecodeError) as e:
+        logger.error("Could not search {0}: {1}".format(note.abspath, e))
+        return False
+    return True
+
+
+def refines(search_words, previous_words):
+    """Return True if `search_words` can only match a subset of the notes that
+    `previous_words` match.
+
+    That is the case when each of the previous words is contained in one of
+    the new search words, e.g. "pytho" refines "pyth" and "python decor"
+    refines "decor". A case-sensitive previous word must be contained in a
+    case-sensitive new word.
+
+    """
+    for previous_word in previous_words:
+        for search_word in search_words:
+            if previous_word.islower():
+                if previous_word in search_word.lower():
+                    break
+            elif (not search_word.islower()) and previous_word in search_word:
+                break
+        else:
+            return False
+    return True
+
+
+class CancellableNotes(object):
+    """A read-only sequence of notes that can cancel a search.
+
+    Iterating over a CancellableNotes raises SearchCancelledError as soon as
+    the given `cancelled` callable returns True, which aborts any search
+    function that is iterating over it.
+
+    """
+    # How many notes to iterate over between calls to cancelled().
+    check_interval = 64
+
+    def __init__(self, notes, cancelled):
+        self._notes = notes
+        self._cancelled = cancelled
+
+    def __len__(self):
+        return len(self._notes)
+
+    def __getitem__(self, index):
+        return self._notes[index]
+
+    def __iter__(self):
+        for i, note in enumerate(self._notes):
+            if i % self.check_interval == 0 and self._cancelled():
+                raise SearchCancelledError("Search cancelled")
+            yield note
+
+
+def _sort_key(note, order):
+    # The title and extension make keys unique within a notebook, so that
+    # orderings never compare Notes.
+    if order == "title":
+        return (note.title.lower(), note.title, note.extension)
+    return (getattr(note, order), note.title, note.extension)
+
 
 def brute_force_search(notebook, query):
     """Return all notes in `notebook` that match `query`.
@@ -199,7 +879,8 @@ def brute_force_search(notebook, query):
 
     Arguments:
 
-    notebook - the notebook to search (NoteBook)
+    notebook - the notebook to search (NoteBook, or any other sequence of
+        Notes)
 
     query - the query to search for (string)
 
@@ -210,32 +891,39 @@ def brute_force_search(notebook, query):
     This implementation does a brute force search that simply reads every file
     in the notebook looking for the search words.
 
+    """
+    return list(iter_matching_notes(notebook, query))
+
+
+def iter_matching_notes(notes, query):
+    """Yield the notes in `notes` that match `query`, one at a time.
+
+    Like brute_force_search() but a generator, so the first matching notes
+    can be used before the rest have been read.
+
     """
     search_words = query.strip().split()
-    matching_notes = []
-    for note in notebook:
-        match = True
-        for search_word in search_words:
-            if search_word.islower():
-                # Search for word case-insensitively.
-                in_title = search_word in note.title.lower()
-                in_contents = search_word in note.contents.lower()
-            else:
-                # Search for word case-sensitively.
-                in_title = search_word in note.title
-                in_contents = search_word in note.contents
-            if (not in_title) and (not in_contents):
-                match = False
-        if match:
-            matching_notes.append(note)
-    return matching_notes
+    for note in notes:
+        if note_matches(note, search_words):
+            yield note
 
 
 class PlainTextNoteBook(object):
-    """A NoteBook that stores its notes as a directory of plain text files."""
+    """A NoteBook that stores its notes as a directory of plain text files.
+
+    A PlainTextNoteBook can save a manifest of its notes directory (the
+    mtime of each subdirectory and the path, mtime, size and ctime of each note
+    file) beside the directory. On the next run only the subdirectories whose
+    mtime has changed, meaning files have been added to or removed from
+    them, are listed again. The rest of the notes are taken straight from the
+    manifest.
+
+    """
 
     def __init__(self, path, extension, extensions,
-            search_function=brute_force_search, exclude=None):
+            search_function=brute_force_search, exclude=None,
+            cache_size=DEFAULT_CACHE_SIZE, scan_threads=DEFAULT_SCAN_THREADS,
+            manifest=False, rescan=False, load=True):
         """Make a new PlainTextNoteBook for the given path.
 
         If `path` does not exist it will be created (parent directories too).
@@ -258,14 +946,51 @@ class PlainTextNoteBook(object):
 
         search_function -- the function to call to search the notebook
 
+        exclude -- file and directory names to skip when reading the notes
+            directory (list of strings)
+
+        cache_size -- the memory budget for caching note contents, in bytes
+            (int)
+
+        scan_threads -- how many threads to read the notes directory with
+            (int)
+
+        manifest -- whether to use and update a saved manifest of the notes
+            directory to speed up reading it (bool)
+
+        rescan -- whether to ignore the saved manifest and read the whole
+            notes directory again, a new manifest is still saved if
+            `manifest` is True (bool)
+
+        load -- whether to read the notes directory now, if False the
+            notebook starts out empty and load() or load_batches() must be
+            called to read it (bool)
+
         """
         # Expand ~ in path, and transform it into an absolute path.
         self._path = os.path.abspath(os.path.expanduser(path))
+        self.path_prefix = os.path.join(self._path, "")
 
         if extension and not extension.startswith("."):
             extension = "." + extension
         self.extension = extension
         self.search_function = search_function
+        self._search_history = []  # (search words, matching notes) tuples.
+        self._search_history_generation = 0
+        self._search_lock = threading.Lock()
+        self._listeners = []
+        self._orderings = {}  # order -> sorted list of (sort key, Note)
+        # order -> (sort key, Note) tuples loaded since the ordering was last
+        # used, merged into it when it's next needed.
+        self._unmerged = {}
+        self._orderings_lock = threading.Lock()
+        self._scan_threads = scan_threads
+        self._manifest = manifest
+        self._scan_records = None
+        self._rescan = rescan
+        # True while load_batches() is reading the notes directory.
+        self.loading = False
+        self.cache = ContentCache(cache_size)
         self.exclude = exclude
         if not self.exclude: self.exclude = []
 
@@ -287,51 +1012,210 @@ class PlainTextNoteBook(object):
             # TODO: Check that self.path is a directory, if not raise.
             pass
 
-        # Read any existing note files in the notes directory.
         self._notes = []
-        for root, dirs, files in os.walk(self.path):
+        self._notes_by_title = {}  # (title, extension) -> Note
+        self._positions = {}  # id(Note) -> its index in self._notes
 
-            # ignore any dirs we don't want to check
-            for name in self.exclude:
-                if name in dirs:
-                    dirs.remove(name)
+        # Read any existing note files in the notes directory.
+        if load:
+            self.load()
 
-            for filename in files:
+    def load(self):
+        """Read the note files in the notes directory into this notebook.
 
-                # ignore anything listed in our 'exclude' list
-                if filename in self.exclude:
-                    continue
+        Called when the notebook is made, unless it was made with
+        load=False.
 
-                # Ignore hidden and backup files.
-                if filename.startswith('.') or filename.endswith('~'):
-                    continue
+        """
+        for notes in self.load_batches():
+            pass
 
-                if os.path.splitext(filename)[1] not in self.extensions:
-                    continue
+    def load_batches(self):
+        """Read the notes directory, adding its notes to this notebook in
+        batches.
 
-                # Make a Note object for the file and add it to this NoteBook.
-                abspath = os.path.join(root, filename)
-                relpath = os.path.relpath(abspath, self.path)
-                relpath, ext = os.path.splitext(relpath)
-                if relpath is None:
-                    # The filename could not be decoded.
-                    logger.error(
-                            "Could not decode filename: {0}".format(relpath))
-                else:
-                    self.add_new(title=relpath, extension=ext)
+        This is a generator that yields each batch of new Notes (a list)
+        after adding it to the notebook, one batch per directory listed. It
+        may be run in a background thread, so that the notes loaded so far
+        can be searched while the rest are read. Files that the notebook
+        already has a Note for, e.g. one made by add_new(), are skipped.
+        Notes whose files were stat-ed to update the manifest start out with
+        their times, so sorting them doesn't stat them again.
+
+        While loading, the notebook's `loading` attribute is True and its
+        search history is cleared after each batch and at the end. Listeners
+        aren't told about the new notes.
+
+        """
+        self.loading = True
+        try:
+            records = (self._load_manifest(self._rescan) if self._manifest
+                    else None)
+            old_records = None if records is None else dict(records)
+            for batch in scan_notes_dir(self.path, self.extensions,
+                    self.exclude, threads=self._scan_threads,
+                    manifest=records, with_times=True):
+                notes = [PlainTextNote(title, self, extension, create=False,
+                            times=None if mtime is None else (mtime, ctime))
+                        for title, extension, mtime, ctime in batch
+                        if (title, extension) not in self._notes_by_title]
+                self._add_loaded(notes)
+                yield notes
+            if self._manifest and records != old_records:
+                self._save_manifest(records)
+            self._scan_records = records
+            # Merge the loaded notes into the orderings once, now, rather
+            # than in whichever search needs them next.
+            with self._orderings_lock:
+                for order in list(self._orderings):
+                    self._ordering(order)
+            self._finish_loading()
+        finally:
+            self.loading = False
+            # Search functions may have answered differently while loading.
+            self.clear_search_history()
+
+    def _finish_loading(self):
+        """Called by load_batches() once all of the notes have been added,
+        before `loading` becomes False."""
+
+    def _add_loaded(self, notes):
+        # The notes are added to the orderings that exist at the same time
+        # as to the notebook, so that an ordering made in between doesn't get
+        # them twice.
+        with self._orderings_lock:
+            for note in notes:
+                self._append(note)
+            orders = list(self._orderings)
+        # The notes' files are stat-ed and their keys sorted without holding
+        # the lock, sort() can go on using the orderings meanwhile. The
+        # sorted batch is only merged into an ordering when it's next used,
+        # so loading many small directories doesn't re-sort it each time.
+        if any(order != "title" for order in orders):
+            self._read_times(notes)
+        for order in orders:
+            entries = sorted((_sort_key(note, order), note) for note in notes)
+            with self._orderings_lock:
+                self._unmerged[order].extend(entries)
+        # Searches that started before this batch was added may have missed
+        # it, don't narrow down their results.
+        self.clear_search_history()
+
+    def take_scan_records(self):
+        """Return the directory records of this notebook's last scan of its
+        notes directory, and forget them.
+
+        The records are the notebook's manifest (see scan_notes_dir()), so
+        that a watcher can start watching the notes directory without
+        listing it again (see watch.watch_notebook()). Returns None if the
+        notebook doesn't keep a manifest, or the records have been taken.
+
+        """
+        records, self._scan_records = self._scan_records, None
+        return records
 
     @property
     def path(self):
         return self._path
 
-    def search(self, query):
+    @property
+    def manifest_path(self):
+        """The path of the file this notebook's manifest is saved in."""
+
+        return sidecar_path(self.path, "tv2manifest")
+
+    def _manifest_key(self):
+        # A manifest is only valid for the same directory, scanned with the
+        # same settings.
+        return (self.path, sorted(self.extensions), sorted(self.exclude))
+
+    def _load_manifest(self, rescan=False):
+        """Return the directory records from the saved manifest, if valid."""
+
+        if rescan:
+            return {}
+        state = load_cache(self.manifest_path)
+        if (not isinstance(state, dict)
+                or state.get("version") != MANIFEST_VERSION
+                or state.get("key") != self._manifest_key()):
+            return {}
+        return state["dirs"]
+
+    def _save_manifest(self, records):
+        save_cache({
+            "version": MANIFEST_VERSION,
+            "key": self._manifest_key(),
+            "dirs": records,
+            }, self.manifest_path)
+
+    def search(self, query, cancelled=None):
         """Return a sequence of Notes that match the given query.
 
+        Recent queries and their results are remembered. Repeating a recent
+        query (e.g. after deleting the last character typed) returns the
+        remembered results without searching again, and a query that refines
+        a recent one (e.g. after typing one more character) only searches the
+        notes that matched that query.
+
+        This method may be called from a background thread.
+
+        Raises SearchCancelledError if `cancelled` returns True before the
+        search finishes (only search functions that support searching
+        subsets of the notebook can be interrupted).
+
         Arguments:
         query -- the search query match notes against (string)
+        cancelled -- a callable that returns True if the search should be
+            abandoned (optional)
 
         """
-        return self.search_function(self, query)
+        search_words = tuple(query.strip().split())
+        searches_subsets = getattr(
+                self.search_function, "searches_subsets", True)
+        with self._search_lock:
+            history = self._search_history
+            history_generation = self._search_history_generation
+            notes = self
+            for i in range(len(history) - 1, -1, -1):
+                previous_words, previous_results = history[i]
+                if previous_words == search_words:
+                    del history[i + 1:]
+                    if getattr(previous_results, "ranked", False):
+                        return previous_results
+                    return list(previous_results)
+                if searches_subsets and refines(search_words, previous_words):
+                    del history[i + 1:]
+                    notes = getattr(
+                            previous_results, "matches", previous_results)
+                    break
+            else:
+                del history[:]
+
+        if cancelled is not None and searches_subsets:
+            notes = CancellableNotes(notes, cancelled)
+        matching_notes = self.search_function(notes, query)
+
+        with self._search_lock:
+            # Don't remember the results if the history was cleared while we
+            # were searching, they may be stale.
+            if history_generation == self._search_history_generation:
+                if getattr(matching_notes, "ranked", False):
+                    history.append((search_words, matching_notes))
+                else:
+                    history.append((search_words, list(matching_notes)))
+                del history[:-SEARCH_HISTORY_SIZE]
+        return matching_notes
+
+    def clear_search_history(self):
+        """Forget recent search results.
+
+        Call this when notes may have been modified, so that the next search
+        doesn't return or narrow down stale results.
+
+        """
+        with self._search_lock:
+            del self._search_history[:]
+            self._search_history_generation += 1
 
     def add_new(self, title, extension=None):
         """Create a new Note and add it to this NoteBook.
@@ -356,11 +1240,7 @@ class PlainTextNoteBook(object):
         if extension is None:
             extension = self.extension
 
-        # Don't create notes outside of the notes dir.
-        if title.startswith(os.sep):
-            title = title[len(os.sep):]
-
-        title = title.strip()
+        title = self._normalise_title(title)
 
         if not os.path.split(title)[1]:
             # Don't create notes with empty filenames.
@@ -369,16 +1249,293 @@ class PlainTextNoteBook(object):
 
         # Check that we don't already have a note with the same title and
         # extension.
-        for note in self._notes:
-            if note.title == title and note.extension == extension:
-                raise NoteAlreadyExistsError(
-                        "Note already in NoteBook: {0}".format(note.title))
+        if (title, extension) in self._notes_by_title:
+            raise NoteAlreadyExistsError(
+                    "Note already in NoteBook: {0}".format(title))
 
         # Ok, add the note.
         note = PlainTextNote(title, self, extension)
-        self._notes.append(note)
+        self._append(note)
+        self._add_to_orderings(note)
+        self._notify("added", note)
         return note
 
+    def add_existing(self, title, extension):
+        """Add a Note for a note file that has appeared on disk.
+
+        Use this when a note file has been created by something other than
+        this NoteBook. The file isn't touched. Returns the new Note, or the
+        existing one if this NoteBook already has a Note for the file.
+
+        Arguments:
+        title -- the title of the note, its path relative to the notes
+            directory without the extension (string)
+        extension -- the filename extension of the note (string)
+
+        """
+        note = self._notes_by_title.get((title, extension))
+        if note is None:
+            note = PlainTextNote(title, self, extension, create=False)
+            self._append(note)
+            self._add_to_orderings(note)
+            self._notify("added", note)
+        return note
+
+    def forget(self, note):
+        """Remove a Note whose file has gone from this NoteBook.
+
+        Use this when a note file has been deleted or moved away by something
+        other than this NoteBook. Unlike remove() nothing is deleted from
+        disk.
+
+        """
+        self.forget_notes([note])
+
+    def forget_notes(self, notes):
+        """Remove several Notes whose files have gone from this NoteBook.
+
+        Like calling forget() for each of them, but when many notes are
+        forgotten at once (e.g. a whole directory has been deleted) the
+        notebook's list of notes and its orderings are filtered once, rather
+        than each note being looked for in them.
+
+        """
+        forgotten = []
+        for note in notes:
+            note = self.note_at_path(note.abspath)
+            if note is not None:
+                del self._notes_by_title[(note.title, note.extension)]
+                self.cache.discard(note.abspath)
+                forgotten.append(note)
+        if not forgotten:
+            return
+
+        if len(forgotten) < len(self._notes) * FORGET_BY_FILTERING_RATIO:
+            for note in forgotten:
+                self._remove(note)
+                self._remove_from_orderings(note)
+        else:
+            ids = set(map(id, forgotten))
+            with self._orderings_lock:
+                self._notes = [note for note in self._notes
+                        if id(note) not in ids]
+                self._positions = dict((id(note), i)
+                        for i, note in enumerate(self._notes))
+                for order in list(self._orderings):
+                    ordering = self._ordering(order)
+                    ordering[:] = [entry for entry in ordering
+                            if id(entry[1]) not in ids]
+        for note in forgotten:
+            self._notify("removed", note)
+
+    def note_changed(self, note):
+        """Tell this NoteBook that a Note's file has been modified."""
+
+        note = self.note_at_path(note.abspath)
+        if note is not None:
+            # Move the note to its new place in the orderings.
+            self._remove_from_orderings(note)
+            note._read_times()
+            self._add_to_orderings(note)
+            self._notify("modified", note)
+
+    def sort(self, notes=None, order="mtime"):
+        """Return a list of the given Notes, sorted.
+
+        Notes are sorted newest first for the "mtime" and "ctime" orders, and
+        by title ignoring case for the "title" order.
+
+        The notebook keeps an ordering of all of its notes for each order,
+        made the first time it's needed and updated as notes are added,
+        modified and removed, so sorting doesn't stat any files. A large
+        number of notes (e.g. the results of a short search query) are picked
+        out of the ordering in a single pass, fewer are sorted using the
+        ordering's cached keys.
+
+        This method may be called from a background thread.
+
+        Arguments:
+        notes -- the notes to sort (sequence of this notebook's Notes,
+            defaults to all of them)
+        order -- one of SORT_ORDERS (string)
+
+        """
+        if order not in SORT_ORDERS:
+            raise ValueError("Unknown sort order: {0}".format(order))
+        reverse = order != "title"
+        if order != "title" and order not in self._orderings:
+            # Stat the files before taking the lock, not while holding it.
+            self._read_times()
+        with self._orderings_lock:
+            ordering = self._ordering(order)
+            if notes is None:
+                entries = reversed(ordering) if reverse else ordering
+                return [note for key, note in entries]
+            if len(notes) >= len(ordering) * SORT_BY_FILTERING_RATIO:
+                ids = set(map(id, notes))
+                entries = reversed(ordering) if reverse else ordering
+                return [note for key, note in entries if id(note) in ids]
+            return sorted(notes, key=lambda note: _sort_key(note, order),
+                    reverse=reverse)
+
+    def notes_with_title_prefix(self, prefix):
+        """Return the Notes whose titles begin with `prefix`, ignoring case.
+
+        The notes are found by bisecting the notebook's title ordering (see
+        sort()), so this takes time logarithmic in the size of the notebook
+        plus the number of notes returned. They are returned in title order.
+
+        This method may be called from a background thread.
+
+        """
+        prefix = prefix.lower()
+        notes = []
+        with self._orderings_lock:
+            ordering = self._ordering("title")
+            i = bisect.bisect_left(ordering, ((prefix,),))
+            while i < len(ordering) and ordering[i][0][0].startswith(prefix):
+                notes.append(ordering[i][1])
+                i += 1
+        return notes
+
+    def _ordering(self, order):
+        # Must be called with the orderings lock held. Any notes whose times
+        # haven't been read yet are stat-ed here, call _read_times() first.
+        ordering = self._orderings.get(order)
+        if ordering is None:
+            ordering = [(_sort_key(note, order), note) for note in self._notes]
+            ordering.sort()
+            self._orderings[order] = ordering
+            self._unmerged[order] = []
+        unmerged = self._unmerged[order]
+        if unmerged:
+            # Timsort merges the sorted ordering and the loaded batches in
+            # linear time.
+            ordering.extend(unmerged)
+            ordering.sort()
+            del unmerged[:]
+        return ordering
+
+    def _read_times(self, notes=None):
+        """Stat the files of the given notes (all notes by default) whose
+        times haven't been read yet.
+
+        The files are stat-ed by a pool of threads, like scan_notes_dir()
+        lists directories.
+
+        """
+        if notes is None:
+            notes = self._notes
+        notes = [note for note in notes if note._mtime is None]
+        if not notes:
+            return
+        threads = max(1, min(self._scan_threads, len(notes) // 256))
+
+        def read_times(notes):
+            for note in notes:
+                note._read_times()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=threads) as pool:
+            for _ in pool.map(read_times,
+                    [notes[i::threads] for i in range(threads)]):
+                pass
+
+    def _add_to_orderings(self, note):
+        if note._mtime is None:
+            note._read_times()
+        with self._orderings_lock:
+            for order in list(self._orderings):
+                bisect.insort(self._ordering(order),
+                        (_sort_key(note, order), note))
+
+    def _remove_from_orderings(self, note):
+        # Uses the note's sort keys from when it was added, so call this
+        # before re-reading its times.
+        with self._orderings_lock:
+            for order in list(self._orderings):
+                ordering = self._ordering(order)
+                i = bisect.bisect_left(ordering, (_sort_key(note, order),))
+                if i < len(ordering) and ordering[i][1] is note:
+                    del ordering[i]
+
+    def add_listener(self, listener):
+        """Call `listener` whenever a Note is added, modified or removed.
+
+        The listener is called with the event ("added", "modified" or
+        "removed") and the Note as arguments.
+
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _notify(self, event, note):
+        self.clear_search_history()
+        for listener in self._listeners:
+            listener(event, note)
+
+    def get_note(self, title, extension=None):
+        """Return the Note with the given title and extension, or None.
+
+        The title is interpreted the same way as by add_new(), so this finds
+        the note that add_new() would refuse to create with
+        NoteAlreadyExistsError.
+
+        Arguments:
+        title -- the title of the note (string)
+        extension -- the filename extension of the note (string, should
+            start with a dot e.g. ".txt", defaults to the extension for new
+            notes)
+
+        """
+        if extension is None:
+            extension = self.extension
+        return self._notes_by_title.get(
+                (self._normalise_title(title), extension))
+
+    def note_at_path(self, abspath):
+        """Return the Note whose file is at `abspath`, or None."""
+
+        if not abspath.startswith(self.path_prefix):
+            return None
+        return self.note_for_filename(abspath[len(self.path_prefix):])
+
+    def note_for_filename(self, filename):
+        """Return the Note whose file has the given path relative to the
+        notes directory (its title plus extension), or None."""
+
+        for extension in set(self.extensions + [self.extension or ""]):
+            if filename.endswith(extension):
+                note = self._notes_by_title.get(
+                        (filename[:len(filename) - len(extension)],
+                            extension))
+                if note is not None:
+                    return note
+        return None
+
+    def _normalise_title(self, title):
+        # Don't create notes outside of the notes dir.
+        if title.startswith(os.sep):
+            title = title[len(os.sep):]
+        return title.strip()
+
+    def _append(self, note):
+        self._positions[id(note)] = len(self._notes)
+        self._notes.append(note)
+        self._notes_by_title[(note.title, note.extension)] = note
+
+    def _remove(self, note):
+        # Moves the last note into the removed note's place, so that
+        # nothing after it has to be moved up.
+        with self._orderings_lock:
+            position = self._positions.pop(id(note))
+            last = self._notes.pop()
+            if last is not note:
+                self._notes[position] = last
+                self._positions[id(last)] = position
+
     def __len__(self):
         return len(self._notes)
 
@@ -395,4 +1552,8 @@ class PlainTextNoteBook(object):
         return self._notes.__reversed__()
 
     def __contains__(self, note):
-        return (note in self._notes)
+        if isinstance(note, PlainTextNote) and note._notebook is self:
+            return self._notes_by_title.get(
+                    (note.title, note.extension)) is note
+        abspath = getattr(note, 'abspath', None)
+        return abspath is not None and self.note_at_path(abspath) is not None
@@ -0,0 +1,223 @@
+"""A search function that spreads the search over several processes.
+
+Searching is CPU-bound once the note files are cached in memory, so a single
+threaded search function can only use one core. ProcessPoolSearch splits the
+notes into shards and searches them in a pool of worker processes, then
+merges the results back together in the order of the notes in the notebook:
+
+    search = ProcessPoolSearch(workers=8)
+    notebook = PlainTextNoteBook(path, extension, extensions,
+            search_function=search)
+
+The worker processes are started on the first search and kept running, one
+per shard. Each note is given to one worker the first time it's searched and
+always searched by that worker after that, so each worker's ContentCache only
+holds its own shard of the notes. A worker keeps the titles and paths of the
+notes in its shard, so a search only sends it the notes that are new to it
+and the positions in its shard of the notes to search, not the whole list of
+notes. Matching has the same semantics as brute_force_search.
+
+"""
+import array
+import logging
+logger = logging.getLogger(__name__)
+import multiprocessing
+import os
+import threading
+
+from . import notebook as notebook_module
+
+
+# Each worker process's cache of note contents, made by _worker_main().
+_cache = None
+
+
+class _ShardNote(object):
+    """The parts of a Note that a worker process needs to match it."""
+
+    __slots__ = ("title", "abspath")
+
+    def __init__(self, title, abspath):
+        self.title = title
+        self.abspath = abspath
+
+    @property
+    def contents(self):
+        return _cache.get(self.abspath)[0]
+
+    @property
+    def lowercase_contents(self):
+        return _cache.get(self.abspath)[1]
+
+
+def _search_shard(shard, positions, search_words):
+    """Search some of the notes in a shard, in a worker process.
+
+    Arguments:
+    shard -- the worker's notes, a list of (title, abspath) tuples
+    positions -- the positions in `shard` of the notes to search (sequence
+        of ints)
+    search_words -- the words to search for (list of strings)
+
+    Returns the list of the indices in `positions` of the notes that match.
+
+    """
+    matches = []
+    for i, position in enumerate(positions):
+        title, abspath = shard[position]
+        try:
+            if notebook_module.note_matches(
+                    _ShardNote(title, abspath), search_words):
+                matches.append(i)
+        except (IOError, OSError, UnicodeDecodeError):
+            # The file has gone or can't be read, it doesn't match.
+            pass
+    return matches
+
+
+def _worker_main(conn, cache_size):
+    """Answer search requests from a ProcessPoolSearch until told to stop.
+
+    Each request is a (new_notes, positions, search_words) tuple: the
+    (title, abspath) tuples to add to the end of the worker's shard, and the
+    arguments for _search_shard(). None stops the worker.
+
+    """
+    global _cache
+    _cache = notebook_module.ContentCache(cache_size)
+    shard = []
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        new_notes, positions, search_words = request
+        shard.extend(new_notes)
+        conn.send(_search_shard(shard, positions, search_words))
+
+
+class _Worker(object):
+    """A worker process and what the parent knows about its shard."""
+
+    def __init__(self, cache_size):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main,
+                args=(child_conn, cache_size), name="tv2-search-worker")
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.size = 0  # How many notes the worker's shard has.
+        self.unsent = []  # (title, abspath) tuples to add to it.
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.conn.close()
+        self.process.join()
+
+
+class ProcessPoolSearch(object):
+    """A search function that searches notes in a pool of processes."""
+
+    # The notes are read by the worker processes' own caches, not the
+    # notebook's ContentCache.
+    reads_content_cache = False
+
+    def __init__(self, workers=None,
+            cache_size=notebook_module.DEFAULT_CACHE_SIZE):
+        """Make a new ProcessPoolSearch.
+
+        Keyword arguments:
+        workers -- how many worker processes to use (int, defaults to the
+            number of CPUs)
+        cache_size -- the memory budget for each worker's cache of note
+            contents, in bytes (int)
+
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_size = cache_size
+        self._workers = None
+        self._shard_of = {}  # abspath -> (worker, position in its shard)
+        # Several notebooks may be searched at once, see MultiNoteBook, but
+        # the workers only answer one search at a time.
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Must be called with the lock held.
+        if self._workers is None:
+            self._workers = [_Worker(self.cache_size)
+                    for _ in range(self.workers)]
+            self._shard_of = {}
+        return self._workers
+
+    def _stop(self):
+        # Must be called with the lock held.
+        if self._workers is not None:
+            for worker in self._workers:
+                worker.stop()
+            self._workers = None
+            self._shard_of = {}
+
+    def close(self):
+        """Shut down the worker processes."""
+
+        with self._lock:
+            self._stop()
+
+    def _place(self, note, workers):
+        """Return the (worker, position) of `note`, adding it to the
+        smallest shard if it hasn't been searched before."""
+
+        abspath = note.abspath
+        place = self._shard_of.get(abspath)
+        if place is None:
+            worker = min(workers, key=lambda worker: worker.size)
+            place = self._shard_of[abspath] = (worker, worker.size)
+            worker.size += 1
+            worker.unsent.append((note.title, abspath))
+        return place
+
+    def __call__(self, notebook, query):
+        """Return all notes in `notebook` that match `query`."""
+
+        search_words = query.strip().split()
+        notes = list(notebook)
+        if not search_words or not notes:
+            return notes
+
+        with self._lock:
+            workers = self._start()
+            # The notes each worker is to search, and their positions in its
+            # shard.
+            shard_notes = dict((id(worker), []) for worker in workers)
+            positions = dict((id(worker), array.array("l"))
+                    for worker in workers)
+            for note in notes:
+                worker, position = self._place(note, workers)
+                shard_notes[id(worker)].append(note)
+                positions[id(worker)].append(position)
+
+            try:
+                busy = []
+                for worker in workers:
+                    if not positions[id(worker)]:
+                        continue
+                    worker.conn.send((worker.unsent, positions[id(worker)],
+                        search_words))
+                    worker.unsent = []
+                    busy.append(worker)
+                matched = set()
+                for worker in busy:
+                    for i in worker.conn.recv():
+                        matched.add(id(shard_notes[id(worker)][i]))
+            except (IOError, OSError, EOFError) as e:
+                # A worker has died, start again with new ones next time.
+                logger.error("Search worker failed: {0}".format(e))
+                self._stop()
+                raise
+
+        return [note for note in notes if id(note) in matched]
@@ -0,0 +1,111 @@
+"""Previews of notes: the decoded first few kilobytes of their files.
+
+Reading a note's whole file to preview it would make moving through the note
+list as slow as searching, so a PreviewCache only ever reads the head of a
+note's file (PREVIEW_SIZE bytes) and keeps the most recently used previews,
+keyed by the note's path and mtime:
+
+    previews = PreviewCache()
+    text = previews.get(note)
+
+Nothing here imports urwid, see urwid_ui.PreviewPane for showing previews.
+
+"""
+import collections
+import logging
+logger = logging.getLogger(__name__)
+import threading
+
+from . import notebook as notebook_module
+
+
+# How much of a note's file to read for its preview, in bytes.
+PREVIEW_SIZE = 4096
+
+# How many previews a PreviewCache keeps.
+PREVIEW_CACHE_SIZE = 256
+
+
+def read_head(abspath, size=PREVIEW_SIZE):
+    """Return the decoded text at the start of a file.
+
+    At most `size` bytes are read. If the file is longer its head is cut at
+    the last line break, so that no character is cut in half.
+
+    Raises IOError or OSError if the file can't be read.
+
+    """
+    with open(abspath, "rb") as f:
+        data = f.read(size + 1)
+    if len(data) > size:
+        data = data[:size]
+        encoding = notebook_module.bom_encoding(data)
+        if encoding in ("utf-16", "utf-32"):
+            unit = 2 if encoding == "utf-16" else 4
+            data = data[:len(data) - len(data) % unit]
+        else:
+            newline = data.rfind(b"\n")
+            if newline > 0:
+                data = data[:newline + 1]
+            else:
+                # Drop what may be the start of a multi-byte character.
+                end = len(data)
+                while end > len(data) - 3 and data[end - 1] >= 0x80:
+                    end -= 1
+                data = data[:end]
+    return notebook_module.decode(data)[0]
+
+
+class PreviewCache(object):
+    """A least-recently-used cache of note previews.
+
+    A note's preview is only used while the note's mtime is unchanged.
+    Previews can be read from any thread.
+
+    """
+    def __init__(self, max_entries=PREVIEW_CACHE_SIZE, size=PREVIEW_SIZE):
+        """Make a new, empty PreviewCache.
+
+        Keyword arguments:
+        max_entries -- how many previews to keep (int)
+        size -- how much of each note's file to read, in bytes (int)
+
+        """
+        self.max_entries = max_entries
+        self.size = size
+        self._entries = collections.OrderedDict()  # (abspath, mtime) -> text
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cached(self, note):
+        """Return the cached preview of `note`, or None if it hasn't been
+        read (this never reads the note's file)."""
+
+        key = (note.abspath, note.mtime)
+        with self._lock:
+            text = self._entries.pop(key, None)
+            if text is not None:
+                self._entries[key] = text
+            return text
+
+    def get(self, note):
+        """Return the preview of `note`, reading it if it isn't cached.
+
+        Returns an empty preview if the note's file can't be read.
+
+        """
+        text = self.cached(note)
+        if text is not None:
+            return text
+        try:
+            text = read_head(note.abspath, self.size)
+        except (IOError, OSError) as e:
+            logger.error("Could not preview {0}: {1}".format(note.abspath, e))
+            text = ""
+        with self._lock:
+            self._entries[(note.abspath, note.mtime)] = text
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return text
@@ -0,0 +1,249 @@
+"""A search function that ranks matching notes by relevance.
+
+The other search functions return every matching note and leave the ordering
+to the caller, which on a large notebook means sorting (and handing to the
+list box) tens of thousands of notes for a short query that nobody scrolls
+through. RankedSearch scores each matching note instead and returns the
+matches best first:
+
+    search = RankedSearch(k=200)
+    notebook = PlainTextNoteBook(path, extension, extensions,
+            search_function=search)
+
+A note matches a query exactly when it would match with brute_force_search.
+Its score adds up:
+
+- for each search word in the note's title, TITLE_WEIGHT, plus
+  TITLE_PREFIX_WEIGHT if a word in the title starts with the search word
+- QUERY_PREFIX_WEIGHT if the title starts with the whole query
+- for each search word in the note's contents, BODY_WEIGHT scaled by the
+  logarithm of how many times it occurs
+- up to RECENCY_WEIGHT for recently modified notes, halving every
+  RECENCY_HALF_LIFE seconds
+
+Only the top k notes are put in order, by selecting them with a bounded heap.
+The rest are ranked lazily, k at a time, if something reads past them (e.g.
+the user scrolls down the list), so the cost of ordering the results doesn't
+grow with the number of matches.
+
+"""
+import heapq
+import logging
+logger = logging.getLogger(__name__)
+import math
+import re
+import time
+
+
+TITLE_WEIGHT = 8.0
+TITLE_PREFIX_WEIGHT = 4.0
+QUERY_PREFIX_WEIGHT = 16.0
+BODY_WEIGHT = 1.0
+RECENCY_WEIGHT = 2.0
+
+# In seconds.
+RECENCY_HALF_LIFE = 30 * 24 * 60 * 60
+
+# How many notes to put in order at a time.
+DEFAULT_K = 200
+
+
+class RankedResults(object):
+    """The notes that matched a query, best first, ranked lazily.
+
+    A read-only sequence of Notes. The notes are put in order on demand, k at
+    a time, so indexing near the top or iterating over the first few notes
+    doesn't rank the rest.
+
+    """
+    # Tells the notebook and the UI that these results are already in order.
+    ranked = True
+
+    def __init__(self, scored, k=DEFAULT_K):
+        """Make a new RankedResults.
+
+        Arguments:
+        scored -- a list of (-score, position, note) tuples for the matching
+            notes, in the order they were searched
+        k -- how many notes to rank at a time (int)
+
+        """
+        self.k = max(1, k)
+        self._scored = scored
+        self._matches = [entry[2] for entry in scored]
+        self._match_set = None
+        self._ranked = heapq.nsmallest(self.k, scored)
+        if len(self._ranked) < len(scored):
+            # Keep the rest for later. The positions make every entry
+            # unique, so this leaves out exactly the entries ranked already.
+            last = self._ranked[-1]
+            self._heap = [entry for entry in scored if entry > last]
+            self._heapified = False
+        else:
+            self._heap = []
+            self._heapified = True
+        self._ranked = [entry[2] for entry in self._ranked]
+        # Note -> position, for the notes ranked so far.
+        self._positions = dict(
+                (note, position) for position, note in enumerate(self._ranked))
+
+    @property
+    def matches(self):
+        """All the matching notes, unranked, in the order they were searched.
+
+        """
+        return self._matches
+
+    def _rank_more(self):
+        """Rank the next k notes, returns False if they're all ranked."""
+
+        if not self._heap:
+            return False
+        if not self._heapified:
+            heapq.heapify(self._heap)
+            self._heapified = True
+        heap = self._heap
+        ranked = self._ranked
+        positions = self._positions
+        for _ in range(min(self.k, len(heap))):
+            note = heapq.heappop(heap)[2]
+            positions[note] = len(ranked)
+            ranked.append(note)
+        return True
+
+    def __len__(self):
+        return len(self._matches)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        while index >= len(self._ranked):
+            self._rank_more()
+        return self._ranked[index]
+
+    def __iter__(self):
+        i = 0
+        while True:
+            while i < len(self._ranked):
+                yield self._ranked[i]
+                i += 1
+            if not self._rank_more():
+                return
+
+    def __contains__(self, note):
+        if self._match_set is None:
+            self._match_set = set(self._matches)
+        return note in self._match_set
+
+    def index(self, note):
+        """Return the position of `note`, ranking only as far as it.
+
+        Raises ValueError if `note` isn't in the results.
+
+        """
+        position = self._positions.get(note)
+        if position is not None:
+            return position
+        if note not in self:
+            raise ValueError("{0} is not in the results".format(note))
+        while note not in self._positions:
+            self._rank_more()
+        return self._positions[note]
+
+
+def merge(results, k=DEFAULT_K):
+    """Return RankedResults holding the notes of several RankedResults.
+
+    The notes are ranked by their scores, with ties going to the notes of the
+    earlier results (e.g. the results of searching several notebooks).
+
+    """
+    scored = []
+    for ranked_results in results:
+        for entry in ranked_results._scored:
+            scored.append((entry[0], len(scored), entry[2]))
+    return RankedResults(scored, k)
+
+
+def _word_start_re(search_word):
+    flags = re.UNICODE
+    if search_word.islower():
+        flags |= re.IGNORECASE
+    return re.compile(r"(?<!\w)" + re.escape(search_word), flags)
+
+
+class RankedSearch(object):
+    """A search function that returns matching notes best first.
+
+    Returns a RankedResults for non-empty queries. For an empty query every
+    note matches equally, so all the notes are returned in a plain list for
+    the caller to sort.
+
+    """
+    def __init__(self, k=DEFAULT_K):
+        """Make a new RankedSearch.
+
+        Keyword arguments:
+        k -- how many of the best matching notes to rank up front, and how
+            many more to rank at a time after that (int)
+
+        """
+        self.k = k
+
+    def score(self, note, search_words, word_starts, query, now):
+        """Return the score of `note` for a query, or None if it doesn't match.
+
+        A note whose contents can't be read is scored on its title alone.
+
+        """
+        title = note.title
+        lowercase_title = title.lower()
+        try:
+            contents = note.contents
+            lowercase_contents = note.lowercase_contents
+        except (IOError, OSError, UnicodeDecodeError) as e:
+            logger.error("Could not search {0}: {1}".format(note.abspath, e))
+            contents = lowercase_contents = ""
+        score = 0.0
+        for search_word, word_start in zip(search_words, word_starts):
+            if search_word.islower():
+                in_title = search_word in lowercase_title
+                count = lowercase_contents.count(search_word)
+            else:
+                in_title = search_word in title
+                count = contents.count(search_word)
+            if not (in_title or count):
+                return None
+            if in_title:
+                score += TITLE_WEIGHT
+                if word_start.search(title):
+                    score += TITLE_PREFIX_WEIGHT
+            if count:
+                score += BODY_WEIGHT * (1 + math.log(count))
+
+        if lowercase_title.startswith(query.lower()):
+            score += QUERY_PREFIX_WEIGHT
+        age = max(0.0, now - note.mtime)
+        score += RECENCY_WEIGHT * 0.5 ** (age / RECENCY_HALF_LIFE)
+        return score
+
+    def __call__(self, notes, query):
+        """Return the notes in `notes` that match `query`, best first."""
+
+        search_words = query.strip().split()
+        if not search_words:
+            return list(notes)
+
+        query = " ".join(search_words)
+        word_starts = [_word_start_re(word) for word in search_words]
+        now = time.time()
+        scored = []
+        for position, note in enumerate(notes):
+            score = self.score(note, search_words, word_starts, query, now)
+            if score is not None:
+                scored.append((-score, position, note))
+        return RankedResults(scored, self.k)
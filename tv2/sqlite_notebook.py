@@ -0,0 +1,394 @@
+"""A NoteBook that mirrors its notes into an SQLite full-text index.
+
+SQLiteNoteBook is a drop-in replacement for PlainTextNoteBook (see the
+notebook module). The notes are still plain text files in the notes
+directory, which stays the source of truth, but the title, path, mtime, size
+and contents of each note are also kept in an SQLite database beside the
+notes directory (see notebook.sidecar_path()), with an FTS5 full-text index
+over the titles and contents:
+
+    notebook = SQLiteNoteBook(path, extension, extensions)
+    matching_notes = notebook.search(query)
+
+When the notebook is made, every note file's mtime and size are compared with
+the ones in the database and only new or modified notes are read. Notes that
+are added, modified or removed while tv2 runs (see
+PlainTextNoteBook.add_listener()) are updated in the database straight away.
+
+The index uses FTS5's trigram tokenizer, so any search word three or more
+characters long is found as a substring using the index, however many notes
+there are. Searches have the same semantics as brute_force_search: lower
+case words match case-insensitively, other words case-sensitively. The index
+is case-insensitive, so case-sensitive words are narrowed down using the
+index and then checked with instr(). Words too short for the trigram index
+are checked with instr() against a lower-cased copy of each note's title and
+contents, lower-cased by Python like brute_force_search does.
+
+Like PlainTextNoteBook's search history, the ids of the notes that matched
+recent queries are remembered (in temporary tables), and a query that
+refines one of them (e.g. after typing one more character) only checks
+those notes.
+
+SQLite 3.34 or later, built with FTS5, is needed for the trigram tokenizer.
+
+"""
+import logging
+logger = logging.getLogger(__name__)
+import os
+import sqlite3
+import threading
+
+from . import notebook as notebook_module
+
+
+# Bump this when the database schema changes, old databases are rebuilt.
+SCHEMA_VERSION = 2
+
+# Search words shorter than this can't be looked up in a trigram index.
+MIN_INDEXED_WORD = 3
+
+# How many notes _sync() writes to the database at a time. The database is
+# locked while they're written, but not while they're read.
+SYNC_BATCH_SIZE = 256
+
+# How many recent queries' results FullTextSearch remembers.
+RESULTS_HISTORY_SIZE = 8
+
+
+def _lowercase(note, contents):
+    # The text that lower case search words are looked for in.
+    return (note.title + "\n" + contents).lower()
+
+
+def _phrase(search_word):
+    # An FTS5 string that matches `search_word` exactly.
+    return '"' + search_word.replace('"', '""') + '"'
+
+
+class FullTextSearch(object):
+    """The search function of an SQLiteNoteBook, answers queries from its
+    database.
+
+    """
+    # The database is searched as a whole, not subsets of the notes. It
+    # narrows searches down to the results of previous ones itself.
+    searches_subsets = False
+
+    # Searches only read the database, not the note files.
+    reads_content_cache = False
+
+    def __init__(self, notebook):
+        self.notebook = notebook
+
+    def __call__(self, notes, query):
+        """Return the notes in the notebook that match `query`."""
+
+        search_words = query.strip().split()
+        if not search_words:
+            return list(self.notebook)
+
+        conditions = []
+        params = []
+        uses_fts = False
+        indexed_words = [_phrase(word) for word in search_words
+                if len(word) >= MIN_INDEXED_WORD]
+        if indexed_words:
+            conditions.append("notes_fts MATCH ?")
+            params.append(" AND ".join(indexed_words))
+            uses_fts = True
+        for search_word in search_words:
+            if not search_word.islower():
+                conditions.append(
+                        "(instr(notes_fts.title, ?) OR "
+                        "instr(notes_fts.contents, ?))")
+                params.extend([search_word, search_word])
+                uses_fts = True
+            elif len(search_word) < MIN_INDEXED_WORD:
+                conditions.append("instr(notes.lowercase, ?)")
+                params.append(search_word)
+
+        tables = "notes"
+        if uses_fts:
+            tables += " JOIN notes_fts ON notes_fts.rowid = notes.id"
+        filenames = self.notebook.query_matching_filenames(
+                search_words, tables, " AND ".join(conditions), params)
+        return self.notebook.notes_for_filenames(filenames)
+
+
+class SQLiteNoteBook(notebook_module.PlainTextNoteBook):
+    """A PlainTextNoteBook that keeps an SQLite full-text index of its notes.
+
+    """
+    def __init__(self, path, extension, extensions, search_function=None,
+            load=True, **kwargs):
+        """Make a new SQLiteNoteBook for the given path.
+
+        Takes the same arguments as PlainTextNoteBook. If no search_function
+        is given the notebook's database is searched.
+
+        Raises NewNoteBookError if the database can't be opened or SQLite
+        doesn't support FTS5 with the trigram tokenizer.
+
+        """
+        super(SQLiteNoteBook, self).__init__(path, extension, extensions,
+                search_function=search_function or FullTextSearch(self),
+                load=False, **kwargs)
+        self._db_lock = threading.Lock()
+        self._db = self._connect()
+        # (search words, name of the temporary table of the ids of the notes
+        # that matched) for recent queries, most recent last. Emptied when
+        # the notes in the database change.
+        self._results_history = []
+        self._results_tables = 0  # How many have been made.
+        self.add_listener(self._on_change)
+        if load:
+            self.load()
+
+    def _finish_loading(self):
+        # Until the notes have been loaded searches are answered from the
+        # database as it was, for the notes loaded so far.
+        self._sync()
+
+    @property
+    def database_path(self):
+        """The path of the file this notebook's database is saved in."""
+
+        return notebook_module.sidecar_path(self.path, "tv2db")
+
+    def _connect(self):
+        try:
+            # The database is searched from background threads, access to it
+            # is serialised by self._db_lock.
+            db = sqlite3.connect(self.database_path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            if db.execute("PRAGMA user_version").fetchone()[0] != (
+                    SCHEMA_VERSION):
+                with db:
+                    db.execute("DROP TABLE IF EXISTS notes")
+                    db.execute("DROP TABLE IF EXISTS notes_fts")
+                    db.execute("CREATE TABLE notes ("
+                            "id INTEGER PRIMARY KEY, "
+                            "filename TEXT UNIQUE NOT NULL, "
+                            "mtime_ns INTEGER NOT NULL, "
+                            "size INTEGER NOT NULL, "
+                            "lowercase TEXT NOT NULL)")
+                    db.execute("CREATE VIRTUAL TABLE notes_fts USING "
+                            "fts5(title, contents, tokenize = 'trigram')")
+                    db.execute("PRAGMA user_version = {0:d}".format(
+                        SCHEMA_VERSION))
+        except sqlite3.Error as e:
+            raise notebook_module.NewNoteBookError(
+                    "Could not open the database {0} (SQLite {1} with FTS5 "
+                    "and the trigram tokenizer is needed): {2}".format(
+                        self.database_path, sqlite3.sqlite_version, e))
+        return db
+
+    def close(self):
+        """Close the notebook's database."""
+
+        with self._db_lock:
+            self._db.close()
+
+    def _stat(self, note):
+        """Return the (mtime, size) of a note's file, or None if it's gone."""
+
+        try:
+            stat = os.stat(note.abspath)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _read(self, note):
+        # Decoded like the notebook's ContentCache does, without filling it
+        # up with every note.
+        try:
+            return self.cache.read(note.abspath)
+        except (IOError, OSError) as e:
+            logger.error("Could not index {0}: {1}".format(note.abspath, e))
+            return ""
+
+    def _store(self, note, stat, contents, lowercase, rowid=None):
+        """Write a note to the database, in the current transaction.
+
+        Arguments:
+        stat -- the (mtime, size) of the note's file
+        contents -- the note's contents (string)
+        lowercase -- the note's title and contents, see _lowercase()
+        rowid -- the note's id in the database, None if it isn't there
+
+        """
+        db = self._db
+        if rowid is None:
+            rowid = db.execute(
+                    "INSERT INTO notes (filename, mtime_ns, size, lowercase) "
+                    "VALUES (?, ?, ?, ?)",
+                    (note.title + note.extension,) + stat + (lowercase,)
+                    ).lastrowid
+        else:
+            db.execute("UPDATE notes SET mtime_ns = ?, size = ?, "
+                    "lowercase = ? WHERE id = ?",
+                    stat + (lowercase, rowid))
+            db.execute("DELETE FROM notes_fts WHERE rowid = ?", (rowid,))
+        db.execute("INSERT INTO notes_fts (rowid, title, contents) "
+                "VALUES (?, ?, ?)", (rowid, note.title, contents))
+        self._forget_results()
+
+    def _delete(self, rowid):
+        self._db.execute("DELETE FROM notes WHERE id = ?", (rowid,))
+        self._db.execute("DELETE FROM notes_fts WHERE rowid = ?", (rowid,))
+        self._forget_results()
+
+    def _forget_results(self):
+        # Must be called with the database lock held.
+        for search_words, table in self._results_history:
+            self._db.execute("DROP TABLE temp.{0}".format(table))
+        del self._results_history[:]
+
+    def _sync(self):
+        """Bring the database up to date with the note files.
+
+        Notes whose files have the same mtime and size as in the database
+        are not read again. The others are read and decoded without holding
+        the database lock, and written SYNC_BATCH_SIZE at a time, so that
+        searches and _on_change() only wait for one batch.
+
+        """
+        with self._db_lock:
+            rows = dict((filename, (rowid, (mtime, size)))
+                    for rowid, filename, mtime, size in self._db.execute(
+                        "SELECT id, filename, mtime_ns, size FROM notes"))
+        updated = 0
+        batch = []
+        for note in list(self):
+            filename = note.title + note.extension
+            stat = self._stat(note)
+            if stat is None:
+                # The file has gone, its row (if any) is deleted below.
+                continue
+            rowid, stored = rows.pop(filename, (None, None))
+            if stat != stored:
+                contents = self._read(note)
+                batch.append((note, stat, contents,
+                    _lowercase(note, contents), stored))
+                if len(batch) >= SYNC_BATCH_SIZE:
+                    updated += self._store_batch(batch)
+                    batch = []
+        updated += self._store_batch(batch)
+        with self._db_lock:
+            with self._db:
+                for rowid, _ in rows.values():
+                    self._delete(rowid)
+        if updated or rows:
+            logger.debug("Indexed {0} new or modified notes and removed {1} "
+                    "in {2}".format(updated, len(rows), self.database_path))
+
+    def _store_batch(self, batch):
+        """Write a batch of notes read by _sync() to the database.
+
+        `batch` is a list of (note, stat, contents, lowercase, stored)
+        tuples, where `stored` is the note's (mtime, size) in the database
+        when _sync() started. Notes that _on_change() has written since are
+        skipped. Returns how many notes were written.
+
+        """
+        stored_count = 0
+        with self._db_lock:
+            with self._db:
+                for note, stat, contents, lowercase, stored in batch:
+                    row = self._db.execute(
+                            "SELECT id, mtime_ns, size FROM notes "
+                            "WHERE filename = ?",
+                            (note.title + note.extension,)).fetchone()
+                    if (None if row is None else tuple(row[1:])) != stored:
+                        continue
+                    self._store(note, stat, contents, lowercase,
+                            None if row is None else row[0])
+                    stored_count += 1
+        return stored_count
+
+    def _on_change(self, event, note):
+        filename = note.title + note.extension
+        stat = None if event == "removed" else self._stat(note)
+        if stat is not None:
+            contents = self._read(note)
+            lowercase = _lowercase(note, contents)
+        with self._db_lock:
+            with self._db:
+                row = self._db.execute(
+                        "SELECT id FROM notes WHERE filename = ?",
+                        (filename,)).fetchone()
+                rowid = None if row is None else row[0]
+                if stat is not None:
+                    self._store(note, stat, contents, lowercase, rowid)
+                elif rowid is not None:
+                    self._delete(rowid)
+
+    def query_filenames(self, sql, params=()):
+        """Run a query on the database that selects note filenames.
+
+        Returns a list of the filenames.
+
+        """
+        with self._db_lock:
+            return [row[0] for row in self._db.execute(sql, params)]
+
+    def query_matching_filenames(self, search_words, tables, condition,
+            params=()):
+        """Return the filenames of the notes that match a query.
+
+        The query's results are remembered. If the search words refine
+        those of a recent query (see notebook.refines()) only the notes
+        that matched it are checked.
+
+        Arguments:
+        search_words -- the query's search words (list of strings)
+        tables -- the tables to select from, including "notes" (SQL)
+        condition -- the condition that the matching notes meet (SQL)
+        params -- the parameters of `condition`
+
+        """
+        with self._db_lock:
+            history = self._results_history
+            for i in range(len(history) - 1, -1, -1):
+                previous_words, previous_table = history[i]
+                if notebook_module.refines(search_words, previous_words):
+                    condition = ("notes.id IN (SELECT id FROM temp.{0}) "
+                            "AND ({1})".format(previous_table, condition))
+                    break
+            self._results_tables += 1
+            table = "tv2_results_{0:d}".format(self._results_tables)
+            db = self._db
+            with db:
+                db.execute("CREATE TEMP TABLE {0} (id INTEGER PRIMARY KEY)"
+                        .format(table))
+                db.execute("INSERT INTO temp.{0} SELECT notes.id FROM {1} "
+                        "WHERE {2}".format(table, tables, condition), params)
+                history.append((list(search_words), table))
+                for previous_words, previous_table in history[
+                        :-RESULTS_HISTORY_SIZE]:
+                    db.execute("DROP TABLE temp.{0}".format(previous_table))
+            del history[:-RESULTS_HISTORY_SIZE]
+            return [row[0] for row in db.execute(
+                    "SELECT notes.filename FROM temp.{0} "
+                    "JOIN notes ON notes.id = {0}.id".format(table))]
+
+    def notes_for_filenames(self, filenames):
+        """Return the notes in this notebook with the given filenames (title
+        plus extension), skipping any that it doesn't have."""
+
+        # Like note_for_filename(), without working out the extensions for
+        # every filename.
+        extensions = [(extension, len(extension)) for extension in
+                set(self.extensions + [self.extension or ""])]
+        notes_by_title = self._notes_by_title
+        notes = []
+        for filename in filenames:
+            for extension, length in extensions:
+                if filename.endswith(extension):
+                    note = notes_by_title.get(
+                            (filename[:len(filename) - length], extension))
+                    if note is not None:
+                        notes.append(note)
+                        break
+        return notes
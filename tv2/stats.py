@@ -0,0 +1,193 @@
+"""Latency statistics and profiling, for finding out why tv2 feels slow.
+
+A Stats object collects samples of named measurements: how long each stage
+of handling a keystroke took, how many files a search read... and summarizes
+each one's distribution (median, 95th and 99th percentiles, maximum):
+
+    stats = Stats()
+    with stats.timer("search"):
+        ...
+    stats.add("files read", 12, unit="files")
+    stats.log_summary()
+
+A Profiler runs cProfile and/or tracemalloc for the whole session and logs
+their reports when it's stopped.
+
+Both log at INFO level, to the "tv2.stats" logger.
+
+"""
+import collections
+import contextlib
+import cProfile
+import io
+import logging
+logger = logging.getLogger(__name__)
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+# How many samples of each measurement to keep, the oldest are dropped.
+MAX_SAMPLES = 100000
+
+# How many functions and allocation sites profiling reports list.
+REPORT_LENGTH = 30
+
+
+def percentile(sorted_values, fraction):
+    """Return the value at `fraction` (0 to 1) of the way through a sorted
+    list, or None if it's empty."""
+
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+
+class Stats(object):
+    """Collects samples of named measurements.
+
+    Samples can be added from any thread.
+
+    """
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._samples = collections.OrderedDict()  # name -> deque of values
+        self._units = {}  # name -> unit
+        self._lock = threading.Lock()
+
+    def add(self, name, value, unit="s"):
+        """Add a sample to the measurement `name`.
+
+        Arguments:
+        name -- the name of the measurement (string)
+        value -- the sample (number)
+        unit -- the unit of the measurement, samples in seconds ("s") are
+            reported in milliseconds (string)
+
+        """
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = collections.deque(
+                        maxlen=self.max_samples)
+                self._units[name] = unit
+            samples.append(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Time the body of a with statement as a sample of `name`."""
+
+        start = time.perf_counter()
+        yield
+        # Not reached if the body raised, e.g. a cancelled search.
+        self.add(name, time.perf_counter() - start)
+
+    def summary(self):
+        """Return a dict mapping each measurement's name to a summary dict.
+
+        Each summary has the number of samples ("count"), the "unit", and
+        the "p50", "p95", "p99" and "max" values.
+
+        """
+        with self._lock:
+            items = [(name, sorted(samples), self._units[name])
+                    for name, samples in self._samples.items()]
+        summary = collections.OrderedDict()
+        for name, values, unit in items:
+            summary[name] = {
+                "count": len(values),
+                "unit": unit,
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+                "max": values[-1] if values else None,
+                }
+        return summary
+
+    def format_summary(self):
+        """Return the summary as a list of lines of text."""
+
+        lines = []
+        for name, summary in self.summary().items():
+            if summary["unit"] == "s":
+                values = ["{0:.1f} ms".format(summary[key] * 1000)
+                        for key in ("p50", "p95", "p99", "max")]
+            else:
+                values = ["{0} {1}".format(summary[key], summary["unit"])
+                        for key in ("p50", "p95", "p99", "max")]
+            lines.append("{0}: {1} samples, p50 {2}, p95 {3}, p99 {4}, "
+                    "max {5}".format(name, summary["count"], *values))
+        return lines
+
+    def log_summary(self):
+        """Log the summary of all measurements."""
+
+        lines = self.format_summary()
+        if lines:
+            logger.info("Latency statistics:\n" + "\n".join(lines))
+
+
+class NullStats(object):
+    """Stands in for a Stats when statistics are turned off."""
+
+    def add(self, name, value, unit="s"):
+        pass
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        yield
+
+    def summary(self):
+        return collections.OrderedDict()
+
+    def format_summary(self):
+        return []
+
+    def log_summary(self):
+        pass
+
+
+class Profiler(object):
+    """Profiles the whole session with cProfile and/or tracemalloc."""
+
+    def __init__(self, cpu=True, memory=True):
+        """Make a new Profiler, call start() to start profiling.
+
+        Keyword arguments:
+        cpu -- whether to profile function calls with cProfile (bool)
+        memory -- whether to trace memory allocations with tracemalloc
+            (bool)
+
+        """
+        self.cpu = cpu
+        self.memory = memory
+        self._profile = None
+
+    def start(self):
+        if self.cpu:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        if self.memory:
+            tracemalloc.start()
+
+    def stop(self):
+        """Stop profiling and log the reports."""
+
+        if self._profile is not None:
+            self._profile.disable()
+            out = io.StringIO()
+            pstats.Stats(self._profile, stream=out).sort_stats(
+                    "cumulative").print_stats(REPORT_LENGTH)
+            logger.info("CPU profile (main thread):\n" + out.getvalue())
+            self._profile = None
+        if self.memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = ["Memory: {0:.1f} MB allocated, {1:.1f} MB peak, "
+                    "top allocation sites:".format(
+                        current / 1048576.0, peak / 1048576.0)]
+            for stat in snapshot.statistics("lineno")[:REPORT_LENGTH]:
+                lines.append(str(stat))
+            logger.info("\n".join(lines))
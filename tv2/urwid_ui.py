@@ -3,23 +3,55 @@
 Implemented using the console user interface library urwid.
 
 """
+import collections
+import functools
+import os
+import re
 import sys
 import subprocess
 import shlex
 import pipes
+import threading
+import time
 import logging
 logger = logging.getLogger(__name__)
 
 import urwid
+from . import multi_notebook
 from . import notebook
+from . import preview as preview_module
+from . import stats as stats_module
+from . import watch
 
 
+# How many NoteWidgets a NoteListWalker keeps around for reuse.
+WIDGET_CACHE_SIZE = 512
+
+# How often to update the note list with newly loaded notes while the
+# notebook is loading in the background, in seconds.
+LOAD_REFRESH_INTERVAL = 0.2
+
+# How many lines of the focused note the preview pane shows.
+PREVIEW_HEIGHT = 8
+
+# How long the focus has to stay on a note before its preview is read, in
+# seconds, so that holding an arrow key down doesn't read every note passed.
+PREVIEW_DELAY = 0.05
+
+# How many notes above and below the focused one to read previews of in
+# advance.
+PREVIEW_PREFETCH = 2
+
+# Tells MainFrame.show_results() to find the note to autocomplete itself.
+_NOT_FOUND_YET = object()
+
 palette = [
     ("placeholder", "dark blue", "default"),
     ("notewidget unfocused", "default", "default"),
     ("notewidget focused", "black", "brown"),
     ("search", "default", "default"),
     ("autocomplete", "black", "brown"),
+    ("preview match", "black", "dark cyan"),
     ]
 
 
@@ -153,6 +185,111 @@ class AutocompleteWidget(urwid.Edit):
             return False
 
 
+class NoteListWalker(urwid.ListWalker):
+    """A list walker over a sequence of notes that makes widgets lazily.
+
+    NoteWidgets are only made for the notes that the list box asks for, which
+    is roughly the ones on screen, and a bounded number of them are cached
+    for reuse. Replacing the notes with set_notes() doesn't make any widgets
+    at all, so it costs the same however many notes there are.
+
+    The list walker also maps notes to their positions in the list, so that
+    a note can be found and focused in constant time. The map is built
+    lazily, only going as far down the list as the notes looked for, so
+    finding a note near the top (e.g. the autocompleted one) doesn't go
+    through the rest.
+
+    """
+    def __init__(self, notes=(), cache_size=WIDGET_CACHE_SIZE):
+        self._notes = notes
+        self._positions = {}  # note -> position, built lazily.
+        # How many of the notes, from the top, are in _positions.
+        self._positions_end = 0
+        self.focus = 0
+        self.cache_size = cache_size
+        self._widgets = collections.OrderedDict()  # note -> NoteWidget
+
+    def get_notes(self):
+        return self._notes
+
+    def set_notes(self, notes):
+        """Replace the notes in this list walker and focus the first one.
+
+        Arguments:
+        notes -- the notes to show, any sequence that supports len() and
+            indexing (the list walker keeps a reference to it, so it must not
+            be changed afterwards)
+
+        """
+        self._notes = notes
+        self._positions = {}
+        self._positions_end = 0
+        self.focus = 0
+        self._modified()
+
+    notes = property(get_notes, set_notes)
+
+    def position_of(self, note):
+        """Return the position of `note` in this list walker, or None."""
+
+        # Usually the note is already focused, e.g. because the user moved
+        # the focus to it with the arrow keys.
+        if 0 <= self.focus < len(self._notes) and (
+                self._notes[self.focus] == note):
+            return self.focus
+        if getattr(self._notes, "ranked", False):
+            # Ranked results are put in order lazily and know the positions
+            # of the notes ranked so far, e.g. by find_autocompletable_note()
+            # in the search thread. Notes that didn't match aren't ranked.
+            if note not in self._notes:
+                return None
+            return self._notes.index(note)
+        position = self._positions.get(note)
+        if position is not None:
+            return position
+        positions = self._positions
+        notes = self._notes
+        for position in range(self._positions_end, len(notes)):
+            other_note = notes[position]
+            positions.setdefault(other_note, position)
+            if other_note == note:
+                self._positions_end = position + 1
+                return position
+        self._positions_end = len(notes)
+        return None
+
+    def __len__(self):
+        return len(self._notes)
+
+    def __getitem__(self, position):
+        if position < 0:
+            raise IndexError(position)
+        note = self._notes[position]
+        widget = self._widgets.pop(note, None)
+        if widget is None:
+            widget = NoteWidget(note)
+            if len(self._widgets) >= self.cache_size:
+                self._widgets.popitem(last=False)
+        # (Re-)insert the widget to mark it most recently used.
+        self._widgets[note] = widget
+        return widget
+
+    def next_position(self, position):
+        return position + 1
+
+    def prev_position(self, position):
+        return position - 1
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self) - 1, -1, -1)
+        return range(len(self))
+
+
 class NoteFilterListBox(urwid.ListBox):
     """A filterable list of notes from a notebook."""
 
@@ -165,8 +302,7 @@ class NoteFilterListBox(urwid.ListBox):
 
         """
         self._fake_focus = False
-        self.list_walker = urwid.SimpleFocusListWalker([])
-        self.widgets = {}  # NoteWidget cache.
+        self.list_walker = NoteListWalker()
         super(NoteFilterListBox, self).__init__(self.list_walker)
         self.on_changed = on_changed
 
@@ -192,35 +328,20 @@ class NoteFilterListBox(urwid.ListBox):
         return super(NoteFilterListBox, self).render(size, self.fake_focus)
 
     def filter(self, matching_notes):
-        """Filter this listbox to show only widgets for matching notes."""
-
-        # Get NoteWidgets for each of the matching Notes, retreive the
-        # NoteWidgets from the NoteWidget cache if possible, if not create new
-        # ones and add them to the cache.
-        matching_widgets = []
-        for note in matching_notes:
-            widget = self.widgets.get(note.abspath)
-            if widget:
-                matching_widgets.append(widget)
-            else:
-                widget = NoteWidget(note)
-                self.widgets[note.abspath] = widget
-                matching_widgets.append(widget)
+        """Filter this listbox to show only widgets for matching notes.
 
-        # Remove all widgets from the list walker.
-        del self.list_walker[:]
+        Widgets are only made for the matching notes that are scrolled into
+        view, see NoteListWalker.
 
-        # Add all the matching widgets to the list walker, in order.
-        for widget in matching_widgets:
-            self.list_walker.append(widget)
+        """
+        self.list_walker.set_notes(matching_notes)
 
     def focus_note(self, note):
         """Focus the widget for the given note."""
 
-        for widget in self.list_walker:
-            if widget.note == note:
-                self.list_walker.set_focus(self.list_walker.index(widget))
-                break
+        position = self.list_walker.position_of(note)
+        if position is not None and position != self.list_walker.focus:
+            self.list_walker.set_focus(position)
 
     def keypress(self, size, key):
         result = super(NoteFilterListBox, self).keypress(size, key)
@@ -234,14 +355,382 @@ class NoteFilterListBox(urwid.ListBox):
         return result
 
 
+def highlight(line, search_words):
+    """Return urwid text markup for a line with the search words in it
+    highlighted.
+
+    Like searches, lower case words match case-insensitively and other words
+    case-sensitively.
+
+    """
+    spans = []
+    for search_word in search_words:
+        flags = re.IGNORECASE if search_word.islower() else 0
+        for match in re.finditer(re.escape(search_word), line, flags):
+            spans.append(match.span())
+    if not spans:
+        return line
+    markup = []
+    end = 0
+    for span_start, span_end in sorted(spans):
+        if span_end <= end:
+            continue
+        if span_start > end:
+            markup.append(line[end:span_start])
+        markup.append(("preview match", line[max(span_start, end):span_end]))
+        end = span_end
+    if end < len(line):
+        markup.append(line[end:])
+    return markup
+
+
+class PreviewPane(urwid.WidgetWrap):
+    """Shows the first lines of a note, with the search words highlighted."""
+
+    def __init__(self, height=PREVIEW_HEIGHT):
+        self.height = height
+        self._text = urwid.Text("", wrap="clip")
+        super(PreviewPane, self).__init__(urwid.BoxAdapter(
+            urwid.LineBox(urwid.Filler(self._text, valign="top")),
+            height + 2))
+
+    def show(self, text, search_words=()):
+        """Show the first lines of `text`."""
+
+        lines = text.split("\n", self.height)[:self.height]
+        markup = []
+        for i, line in enumerate(lines):
+            if i:
+                markup.append("\n")
+            markup.append(highlight(line.expandtabs(), search_words))
+        self._text.set_text(markup)
+
+
+class SearchWorker(object):
+    """Runs searches in a background thread so they don't block the UI.
+
+    Only the most recently submitted query is searched: submitting a new query
+    cancels the one being searched (if the search function supports it) and
+    replaces any that haven't started yet. Results are handed back to the
+    urwid main loop through a pipe, so the results callback always runs in
+    the main loop's thread, and results for stale queries are dropped.
+
+    """
+    def __init__(self, loop, search, on_results):
+        """Start a new SearchWorker thread.
+
+        Arguments:
+        loop -- the urwid.MainLoop to deliver results to
+        search -- callable that does the search, it's called with the query
+            and a callable that returns True if the search has been
+            cancelled, and should return an iterable of the matching notes
+            found so far, with all of them last (see MainFrame.iter_search())
+        on_results -- callable that will be called in the main loop with the
+            query, the matching notes and the data passed to submit(), as
+            they're found
+
+        """
+        self._search = search
+        self._on_results = on_results
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._pending = None
+        self._results = []
+        self._pipe = loop.watch_pipe(self._on_pipe)
+        thread = threading.Thread(target=self._run, name="tv2-search")
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, query, data=None):
+        """Search for `query` in the background."""
+
+        with self._condition:
+            self._generation += 1
+            self._pending = (self._generation, query, data)
+            self._condition.notify()
+
+    def cancel(self):
+        """Cancel any pending or running search."""
+
+        with self._condition:
+            self._generation += 1
+            self._pending = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                generation, query, data = self._pending
+                self._pending = None
+
+            cancelled = lambda: generation != self._generation
+            try:
+                for matching_notes in self._search(query, cancelled):
+                    with self._condition:
+                        if cancelled():
+                            break
+                        self._results.append(
+                                (generation, query, matching_notes, data))
+                    os.write(self._pipe, b"\n")
+            except notebook.SearchCancelledError:
+                continue
+            except Exception as e:
+                logger.exception(e)
+                continue
+
+    def _on_pipe(self, data):
+        with self._condition:
+            results, self._results = self._results, []
+        # Later results for a query include the earlier ones.
+        results = [result for result in results
+                if result[0] == self._generation]
+        if results:
+            generation, query, matching_notes, data = results[-1]
+            self._on_results(query, matching_notes, data)
+        return True
+
+
+class PreviewReader(object):
+    """Reads note previews into a PreviewCache in a background thread.
+
+    Only the most recently submitted notes are read: submitting new ones
+    replaces any that haven't been read yet. The first of the submitted notes
+    is handed back to the urwid main loop through a pipe once it's read, like
+    SearchWorker does with results, the rest are only read into the cache.
+
+    """
+    def __init__(self, loop, previews, on_read):
+        """Start a new PreviewReader thread.
+
+        Arguments:
+        loop -- the urwid.MainLoop to deliver previews to
+        previews -- the preview_module.PreviewCache to read previews into
+        on_read -- callable that will be called in the main loop with the
+            first of the submitted notes and its preview, once it's read
+
+        """
+        self._previews = previews
+        self._on_read = on_read
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._pending = None
+        self._read = []
+        self._pipe = loop.watch_pipe(self._on_pipe)
+        thread = threading.Thread(target=self._run, name="tv2-preview")
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, notes):
+        """Read the previews of `notes` (a list of Notes) in the background.
+
+        """
+        with self._condition:
+            self._generation += 1
+            self._pending = (self._generation, notes)
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                generation, notes = self._pending
+                self._pending = None
+
+            for i, note in enumerate(notes):
+                if generation != self._generation:
+                    break
+                try:
+                    text = self._previews.get(note)
+                except Exception as e:
+                    logger.exception(e)
+                    continue
+                if i == 0:
+                    with self._condition:
+                        self._read.append((generation, note, text))
+                    os.write(self._pipe, b"\n")
+
+    def _on_pipe(self, data):
+        with self._condition:
+            read, self._read = self._read, []
+        read = [entry for entry in read if entry[0] == self._generation]
+        if read:
+            generation, note, text = read[-1]
+            self._on_read(note, text)
+        return True
+
+
+class NoteLoader(object):
+    """Loads a notebook's notes in a background thread.
+
+    The notebook must have been made with load=False, see
+    PlainTextNoteBook.load_batches(). As each batch of notes is added to the
+    notebook it's searched for the current query, still in the background
+    thread, and the matching notes are handed to the urwid main loop through
+    a pipe, like SearchWorker does.
+
+    """
+    def __init__(self, loop, notebook, get_query, on_batch, on_loaded):
+        """Start a new NoteLoader thread.
+
+        Arguments:
+        loop -- the urwid.MainLoop to deliver batches to
+        notebook -- the notebook to load
+        get_query -- callable that returns the current query, it's called
+            from the background thread
+        on_batch -- callable that will be called in the main loop with the
+            query a batch was searched for and the notes in it that match,
+            or None if the notebook's search function can't search a batch
+            on its own
+        on_loaded -- callable that will be called in the main loop once all
+            the notes have been loaded
+
+        """
+        self._notebook = notebook
+        self._get_query = get_query
+        self._on_batch = on_batch
+        self._on_loaded = on_loaded
+        self._lock = threading.Lock()
+        self._batches = []  # (query, matching notes) tuples, None at the end
+        self._pipe = loop.watch_pipe(self._on_pipe)
+        thread = threading.Thread(target=self._run, name="tv2-load")
+        thread.daemon = True
+        thread.start()
+
+    def search(self, notes, query):
+        """Return the notes in a newly loaded batch that match `query`.
+
+        Returns None if they can't be searched on their own, because the
+        search function searches whole notebooks or ranks its results
+        (which would have to be ranked together with the rest).
+
+        """
+        if not query.strip():
+            return notes
+        search_function = self._notebook.search_function
+        if not getattr(search_function, "searches_subsets", True):
+            return None
+        matching_notes = search_function(notes, query)
+        if getattr(matching_notes, "ranked", False):
+            return None
+        return list(matching_notes)
+
+    def _run(self):
+        try:
+            for notes in self._notebook.load_batches():
+                query = self._get_query()
+                try:
+                    matching_notes = self.search(notes, query)
+                except Exception as e:
+                    logger.exception(e)
+                    matching_notes = None
+                self._post((query, matching_notes))
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self._post(None)
+            os.close(self._pipe)
+
+    def _post(self, batch):
+        with self._lock:
+            # The main loop takes all the batches each time it's woken up,
+            # so it only needs waking up for the first one.
+            wake = not self._batches
+            self._batches.append(batch)
+        if wake:
+            os.write(self._pipe, b"\n")
+
+    def _on_pipe(self, data):
+        with self._lock:
+            batches, self._batches = self._batches, []
+        for batch in batches:
+            if batch is None:
+                self._on_loaded()
+                return False
+            self._on_batch(*batch)
+        return True
+
+
 class MainFrame(urwid.Frame):
     """The topmost urwid widget."""
 
-    def __init__(self, notes_dir, editor, extension, extensions, exclude=None):
+    def __init__(self, notes_dir, editor, extension, extensions, exclude=None,
+            search_function=notebook.brute_force_search, sort="mtime",
+            cache_size=notebook.DEFAULT_CACHE_SIZE, debounce=0, rescan=False,
+            stats=None, notebook_class=notebook.PlainTextNoteBook,
+            load=True, preview=False):
+        """Initialise a new MainFrame.
+
+        If a stats.Stats object is given, the time taken by each stage of
+        handling a keystroke (search, sort, list filter and render) and the
+        whole time from a keystroke to its results being rendered
+        (keystroke) are recorded in it, along with how many note files and
+        bytes each search had to read, and how long making the notebook
+        (startup) and loading it in the background (load) took.
 
+        `notes_dir` may be a list of notes directories, which are searched
+        together, with the one to add new notes to first (see
+        multi_notebook.MultiNoteBook).
+
+        Keyword arguments:
+        sort -- the order to list notes in, one of notebook.SORT_ORDERS
+            (string)
+        rescan -- whether to read the whole notes directory rather than
+            trusting the notebook's saved manifest (bool)
+        debounce -- how long to wait after a keypress in the search box before
+            searching, in seconds, so that fast typing doesn't start a search
+            for each character (float)
+        stats -- where to record latency statistics (stats.Stats)
+        notebook_class -- the NoteBook class to use, it's called with the
+            same arguments as PlainTextNoteBook
+        load -- whether to read the notes directory now, if False call
+            load_in_background() once the main loop has been set (bool)
+        preview -- whether to show a preview of the selected note below the
+            note list (bool)
+
+        """
         self.editor = editor
-        self.notebook = notebook.PlainTextNoteBook(notes_dir, extension,
-                extensions, exclude=exclude)
+        self.stats = stats or stats_module.NullStats()
+        # When the last keystroke in the search box happened, until its
+        # results have been rendered.
+        self._keystroke_time = None
+        self._results_shown = False
+        self.sort_order = sort
+        self.debounce = debounce
+
+        # The urwid.MainLoop, set by launch(). Searches are run synchronously
+        # until there is a main loop to deliver their results to.
+        self.loop = None
+        self._search_worker = None
+        self._watchers = []
+        self._debounce_alarm = None
+        with self.stats.timer("startup"):
+            self.notebook = multi_notebook.make_notebook(notes_dir,
+                    extension, extensions, notebook_class=notebook_class,
+                    search_function=search_function, exclude=exclude,
+                    cache_size=cache_size, manifest=True, rescan=rescan,
+                    load=load)
+
+        # The most recent query filtered for, and the one whose results are
+        # shown.
+        self._query = ""
+        self._shown_query = None
+
+        # While the notebook loads in the background, the notes loaded since
+        # searching for _loaded_query that match it (None if the search has
+        # to be run again instead), see load_in_background().
+        self._loader = None
+        self._loaded_query = None
+        self._loaded_notes = []
+        self._load_alarm = None
+
+        # The preview pane, if there is one, and the previews shown in it.
+        self.preview_pane = PreviewPane() if preview else None
+        self.previews = preview_module.PreviewCache()
+        self._preview_alarm = None
+        self._preview_reader = None
+        self._preview_requested = None  # When the reader was last asked.
 
         # Don't filter the note list when the text in the search box changes.
         self.suppress_filter = False
@@ -261,6 +750,7 @@ class MainFrame(urwid.Frame):
         super(MainFrame, self).__init__(
                 header=urwid.LineBox(self.search_box),
                 body=None,
+                footer=self.preview_pane,
                 focus_part="body")
 
         # Add all the notes to the listbox.
@@ -297,6 +787,7 @@ class MainFrame(urwid.Frame):
             self.list_box.fake_focus = False
 
         self._selected_note = note
+        self.update_preview()
 
     selected_note = property(get_selected_note, set_selected_note)
 
@@ -322,8 +813,10 @@ class MainFrame(urwid.Frame):
                 return None
 
         elif key in ["enter"]:
+            note = None
             if self.selected_note:
-                system(self.editor + ' ' + pipes.quote(self.selected_note.abspath), self.loop)
+                note = self.selected_note
+                system(self.editor + ' ' + pipes.quote(note.abspath), self.loop)
             else:
                 if self.search_box.edit_text:
                     try:
@@ -331,8 +824,9 @@ class MainFrame(urwid.Frame):
                         system(self.editor + ' ' + pipes.quote(note.abspath), self.loop)
                     except notebook.NoteAlreadyExistsError:
                         # Try to open the existing note instead.
-                        system(self.editor + ' ' + pipes.quote(self.search_box.edit_text +
-                                self.notebook.extension),
+                        note = self.notebook.get_note(
+                                self.search_box.edit_text)
+                        system(self.editor + ' ' + pipes.quote(note.abspath),
                             self.loop)
                     except notebook.InvalidNoteTitleError:
                         # TODO: Display error message to user.
@@ -341,6 +835,11 @@ class MainFrame(urwid.Frame):
                     # Hitting Enter with no note selected and no text typed in
                     # search box does nothing.
                     pass
+            # Move the edited note to its new place in the sort order. The
+            # editor may have changed any number of other notes too.
+            if note is not None:
+                self.notebook.note_changed(note)
+            self.notebook.clear_search_history()
             self.suppress_focus = True
             self.filter(self.search_box.edit_text)
             return None
@@ -395,51 +894,437 @@ class MainFrame(urwid.Frame):
         if self.suppress_filter:
             return
 
+        self._query = query
+
+        # Any search still running in the background is out of date now.
+        self._cancel_background_search()
+
+        self.show_results(query, self.search(query))
+
+    def search(self, query, cancelled=None):
+        """Return the notes that match `query`, sorted.
+
+        This may be called from a background thread, it doesn't touch any
+        widgets.
+
+        """
+        cache_reads = self._cache_reads()
+
+        # Find all notes that match the typed text.
+        with self.stats.timer("search"):
+            matching_notes = self.notebook.search(query, cancelled=cancelled)
+        self._add_read_stats(cache_reads)
+        return self._sorted(matching_notes)
+
+    def iter_search(self, query, cancelled=None):
+        """Yield the notes that match `query` found so far, sorted.
+
+        A notebook of several notes directories (see
+        multi_notebook.MultiNoteBook) yields more results each time one of
+        its directories has been searched, so the note list can be updated
+        before the slowest one is done. Other notebooks' results are yielded
+        all at once. The last notes yielded are all of the matching notes.
+
+        This may be called from a background thread, like search().
+
+        """
+        iter_search = getattr(self.notebook, "iter_search", None)
+        if iter_search is None:
+            yield self.search(query, cancelled)
+            return
+
+        cache_reads = self._cache_reads()
+        start = time.perf_counter()
+        for matching_notes in iter_search(query, cancelled=cancelled):
+            yield self._sorted(matching_notes)
+        self.stats.add("search", time.perf_counter() - start)
+        self._add_read_stats(cache_reads)
+
+    def _cache_reads(self):
+        # The (files, bytes) the notebook's ContentCache has read so far, or
+        # None if the search function reads notes some other way (or not at
+        # all), so that the cache's counts say nothing about its searches.
+        if not getattr(self.notebook.search_function, "reads_content_cache",
+                True):
+            return None
+        cache = self.notebook.cache
+        return (cache.files_read, cache.bytes_read)
+
+    def _add_read_stats(self, cache_reads):
+        if cache_reads is None:
+            return
+        files_read, bytes_read = cache_reads
+        cache = self.notebook.cache
+        self.stats.add("cache reads per search",
+                cache.files_read - files_read, unit="files")
+        self.stats.add("cache bytes read per search",
+                cache.bytes_read - bytes_read, unit="bytes")
+
+    def _sorted(self, matching_notes):
+        if getattr(matching_notes, "ranked", False):
+            # The search function has already put them in order.
+            return matching_notes
+
+        with self.stats.timer("sort"):
+            return self.notebook.sort(matching_notes, self.sort_order)
+
+    def show_results(self, query, matching_notes,
+            autocompletable_note=_NOT_FOUND_YET):
+        """Show the given search results in the list box and search box.
+
+        Arguments:
+        autocompletable_note -- the note to autocomplete, as returned by
+            find_autocompletable_note(), found here if not given (Note or
+            None)
+
+        """
+        if autocompletable_note is _NOT_FOUND_YET and not (
+                self.suppress_focus):
+            autocompletable_note = self.find_autocompletable_note(
+                    query, matching_notes)
+
+        # Add any notes loaded after the search started.
+        if self._loader is not None:
+            loaded_notes = self._loaded_notes_matching(query, matching_notes)
+            if loaded_notes:
+                matching_notes = self.notebook.sort(
+                        list(matching_notes) + loaded_notes, self.sort_order)
+                # One of them may come before the note found in the results.
+                lowered_query = query.lower()
+                candidates = [note for note in loaded_notes
+                        if note.title.lower().startswith(lowered_query)]
+                if candidates and not self.suppress_focus:
+                    if autocompletable_note is not None:
+                        candidates.append(autocompletable_note)
+                    autocompletable_note = self.notebook.sort(
+                            candidates, self.sort_order)[0]
+        self._shown_query = query
+
         # If the user has no notes yet show some placeholder text, otherwise
         # show the note list.
-        if len(self.notebook) == 0:
+        if len(self.notebook) == 0 and self._loader is not None:
+            self.body = placeholder_text("Loading notes...")
+        elif len(self.notebook) == 0:
             self.body = placeholder_text("You have no notes yet, to create "
                 "a note type a note title then press Enter")
         else:
             self.body = urwid.Padding(self.list_box, left=1, right=1)
 
-        # Find all notes that match the typed text.
-        matching_notes = self.notebook.search(query)
+        # Tell the list box to show only the matching notes.
+        with self.stats.timer("list filter"):
+            self.list_box.filter(matching_notes)
+        self._results_shown = True
+
+        if self.suppress_focus:
+            autocompletable_note = None
+        self.selected_note = autocompletable_note
+        if self.suppress_focus:
+            # The selection stays but the preview highlights the new query.
+            self.update_preview()
 
-        # Sort the notes.
-        # TODO: Support different sort orderings.
-        matching_notes.sort(key=lambda x: x.mtime, reverse=True)
+    def filter_in_background(self, query):
+        """Filter for `query` without blocking the UI.
 
-        # Tell the list box to show only the matching notes.
-        self.list_box.filter(matching_notes)
+        The search runs in a background thread (after the debounce delay, if
+        any) and the list box and autocomplete are updated when it finishes.
+
+        """
+        if self.suppress_filter:
+            return
+
+        if self.loop is None:
+            self.filter(query)
+            return
+
+        self._query = query
+
+        if self._search_worker is None:
+            self._search_worker = SearchWorker(self.loop,
+                    self._iter_search_with_autocomplete,
+                    self.on_search_results)
 
-        # Find the notes whose title begins with the typed text.
-        autocompletable_matches = []
-        if query:
+        # The focus suppression applies to the results of this keypress, not
+        # whatever keypress happens to come before the results.
+        suppress_focus = self.suppress_focus
+
+        self._cancel_background_search()
+        if self.debounce:
+            self._debounce_alarm = self.loop.set_alarm_in(self.debounce,
+                    lambda loop, data: self._submit_search(
+                        query, suppress_focus))
+        else:
+            self._submit_search(query, suppress_focus)
+
+    def _submit_search(self, query, suppress_focus):
+        self._debounce_alarm = None
+        self._search_worker.submit(query, suppress_focus)
+
+    def _cancel_background_search(self):
+        if self._debounce_alarm is not None:
+            self.loop.remove_alarm(self._debounce_alarm)
+            self._debounce_alarm = None
+        if self._search_worker is not None:
+            self._search_worker.cancel()
+
+    def _iter_search_with_autocomplete(self, query, cancelled):
+        # Run by the SearchWorker. The note to autocomplete is found in the
+        # background thread too, so the main loop doesn't go through the
+        # results.
+        for matching_notes in self.iter_search(query, cancelled):
+            yield (matching_notes,
+                    self.find_autocompletable_note(query, matching_notes))
+
+    def on_search_results(self, query, results, suppress_focus):
+        matching_notes, autocompletable_note = results
+        saved_suppress_focus = self.suppress_focus
+        self.suppress_focus = suppress_focus
+        try:
+            self.show_results(query, matching_notes, autocompletable_note)
+        finally:
+            self.suppress_focus = saved_suppress_focus
+
+    def load_in_background(self, on_loaded=None):
+        """Load the notebook's notes without blocking the UI.
+
+        For a MainFrame made with load=False, so that it can be shown
+        straight away. The notes are read by a NoteLoader, and every
+        LOAD_REFRESH_INTERVAL seconds the note list is updated with the
+        loaded notes that match the query in the search box. Once all the
+        notes have been loaded they're searched again as a whole.
+
+        Must be called after self.loop has been set.
+
+        Arguments:
+        on_loaded -- called in the main loop once all the notes have been
+            loaded (callable, optional)
+
+        """
+        start = time.perf_counter()
+
+        def loaded():
+            self.stats.add("load", time.perf_counter() - start)
+            self._loader = None
+            self._loaded_query = None
+            self._loaded_notes = []
+            if self._load_alarm is not None:
+                self.loop.remove_alarm(self._load_alarm)
+                self._load_alarm = None
+            self._refilter()
+            if on_loaded is not None:
+                on_loaded()
+
+        self._loader = NoteLoader(self.loop, self.notebook,
+                lambda: self._query, self.on_notes_loaded, loaded)
+        # The note list was filtered before there was a loader, so it says
+        # there are no notes. Until the first batch is shown, say that
+        # they're loading instead.
+        if len(self.list_box.list_walker) == 0:
+            self.body = placeholder_text("Loading notes...")
+
+    def on_notes_loaded(self, query, matching_notes):
+        if query != self._loaded_query:
+            self._loaded_query = query
+            self._loaded_notes = []
+        if matching_notes is None or self._loaded_notes is None:
+            self._loaded_notes = None
+        else:
+            self._loaded_notes.extend(matching_notes)
+        if self._load_alarm is None:
+            self._load_alarm = self.loop.set_alarm_in(LOAD_REFRESH_INTERVAL,
+                    lambda loop, data: self._show_loaded_notes())
+
+    def _show_loaded_notes(self):
+        self._load_alarm = None
+        # Batches searched for an older query are already covered by the
+        # search for the current one, which started after they were loaded.
+        if self._loaded_query != self._query:
+            return
+        shown_notes = self.list_box.list_walker.notes
+        if self._loaded_notes is None or getattr(
+                shown_notes, "ranked", False):
+            # The loaded notes can't just be added, search them all again.
+            self._loaded_query = None
+            self._loaded_notes = []
+            self._refilter()
+        elif self._shown_query == self._query:
+            # Otherwise the loaded notes are added when the results of the
+            # search in progress are shown.
+            saved_suppress_focus = self.suppress_focus
+            self.suppress_focus = True
+            try:
+                self.show_results(self._query, shown_notes)
+            finally:
+                self.suppress_focus = saved_suppress_focus
+
+    def _loaded_notes_matching(self, query, matching_notes):
+        """Return the notes loaded since searching for `query` that match it
+        and aren't in its results `matching_notes`."""
+
+        if query != self._loaded_query or not self._loaded_notes or getattr(
+                matching_notes, "ranked", False):
+            return []
+        matching = set(matching_notes)
+        return [note for note in self._loaded_notes if note not in matching]
+
+    def find_autocompletable_note(self, query, matching_notes):
+        """Return the first of the sorted search results for `query` whose
+        title begins with `query`, ignoring case, or None.
+
+        The results are gone through in order, stopping at the first note
+        found. Lazily ranked results are only gone through if one of them
+        will be found.
+
+        This may be called from a background thread, like search().
+
+        """
+        if not query:
+            return None
+        lowered_query = query.lower()
+        with self.stats.timer("autocomplete"):
+            if getattr(matching_notes, "ranked", False) and not any(
+                    note.title.lower().startswith(lowered_query)
+                    for note in matching_notes.matches):
+                return None
             for note in matching_notes:
-                if note.title.lower().startswith(query.lower()):
-                    autocompletable_matches.append(note)
+                if note.title.lower().startswith(lowered_query):
+                    return note
+        return None
+
+    def _refilter(self):
+        # Filter the list again, without changing the selected note.
+        saved_suppress_focus = self.suppress_focus
+        self.suppress_focus = True
+        try:
+            self.filter_in_background(self.search_box.edit_text)
+        finally:
+            self.suppress_focus = saved_suppress_focus
+
+    def update_preview(self):
+        """Show the selected note in the preview pane, if there is one.
+
+        A cached preview is shown straight away. Otherwise the preview is
+        read once the selection has stayed on the note for PREVIEW_DELAY
+        seconds, along with the previews of the notes next to it.
 
-        # Select the first autocompletable note.
-        if autocompletable_matches:
-            self.selected_note = autocompletable_matches[0]
+        """
+        if self.preview_pane is None:
+            return
+        if self._preview_alarm is not None:
+            self.loop.remove_alarm(self._preview_alarm)
+            self._preview_alarm = None
+        note = self._selected_note
+        if note is None:
+            self.preview_pane.show("")
+            return
+        text = self.previews.cached(note)
+        if text is not None:
+            self._show_preview(text)
         else:
+            self.preview_pane.show("")
+        if self.loop is None:
+            self._read_previews()
+        else:
+            self._preview_alarm = self.loop.set_alarm_in(PREVIEW_DELAY,
+                    lambda loop, data: self._read_previews())
+
+    def _show_preview(self, text):
+        self.preview_pane.show(text, (self._shown_query or "").split())
+
+    def _read_previews(self):
+        # Reads the selected note's preview and prefetches the previews of
+        # the notes next to it, in a PreviewReader thread if there's a main
+        # loop to deliver the preview to.
+        self._preview_alarm = None
+        note = self._selected_note
+        if note is None:
+            return
+        notes = [note]
+        walker = self.list_box.list_walker
+        # Only if the note is focused, without looking for it in the
+        # results (which ranks lazily ranked ones as far as the note).
+        if 0 <= walker.focus < len(walker) and (
+                walker.notes[walker.focus] == note):
+            for offset in range(1, PREVIEW_PREFETCH + 1):
+                for position in (walker.focus + offset,
+                        walker.focus - offset):
+                    if 0 <= position < len(walker):
+                        notes.append(walker.notes[position])
+        if self.loop is None:
+            with self.stats.timer("preview"):
+                self._show_preview(self.previews.get(note))
+                for other_note in notes[1:]:
+                    self.previews.get(other_note)
+            return
+        if self._preview_reader is None:
+            self._preview_reader = PreviewReader(self.loop, self.previews,
+                    self.on_preview_read)
+        self._preview_requested = time.perf_counter()
+        self._preview_reader.submit(notes)
+
+    def on_preview_read(self, note, text):
+        if note != self._selected_note:
+            return
+        self.stats.add("preview",
+                time.perf_counter() - self._preview_requested)
+        self._show_preview(text)
+
+    def watch_notebook(self):
+        """Keep the note list up to date with changes made outside tv2.
+
+        Must be called after self.loop has been set.
+
+        """
+        for watched_notebook in getattr(self.notebook, "notebooks",
+                [self.notebook]):
+            watcher = watch.watch_notebook(watched_notebook)
+            self._watchers.append(watcher)
+            self.loop.watch_file(watcher.fileno(),
+                    functools.partial(self.on_notes_changed, watcher))
+
+    def on_notes_changed(self, watcher):
+        if not watcher.process_events():
+            return
+        if self.selected_note and self.selected_note not in self.notebook:
             self.selected_note = None
+        self._refilter()
+
+    def render(self, size, focus=False):
+        with self.stats.timer("render"):
+            canvas = super(MainFrame, self).render(size, focus)
+        if self._keystroke_time is not None and self._results_shown:
+            self.stats.add("keystroke",
+                    time.perf_counter() - self._keystroke_time)
+            self._keystroke_time = None
+        return canvas
 
     def on_search_box_changed(self, edit, new_edit_text):
-        self.filter(new_edit_text)
+        self._keystroke_time = time.perf_counter()
+        self._results_shown = False
+        self.filter_in_background(new_edit_text)
 
     def on_list_box_changed(self, note):
         self.selected_note = note
 
 
-def launch(notes_dir, editor, extension, extensions, exclude=None):
+def launch(notes_dir, editor, extension, extensions, exclude=None,
+        search_function=notebook.brute_force_search, sort="mtime",
+        cache_size=notebook.DEFAULT_CACHE_SIZE, debounce=0, rescan=False,
+        watch=True, stats=None, notebook_class=notebook.PlainTextNoteBook,
+        preview=False):
     """Launch the user interface."""
 
     urwid.set_encoding(sys.getfilesystemencoding())
 
-    frame = MainFrame(notes_dir, editor, extension, extensions, exclude=exclude)
+    # Show the UI straight away and read the notes directory in the
+    # background. Changes to the notes dir are watched for once it's read.
+    frame = MainFrame(notes_dir, editor, extension, extensions,
+            exclude=exclude, search_function=search_function, sort=sort,
+            cache_size=cache_size, debounce=debounce, rescan=rescan,
+            stats=stats, notebook_class=notebook_class, load=False,
+            preview=preview)
     loop = urwid.MainLoop(frame, palette)
     frame.loop = loop
+    frame.load_in_background(
+            on_loaded=frame.watch_notebook if watch else None)
     loop.run()
 
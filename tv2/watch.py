@@ -0,0 +1,489 @@
+"""Watching a notes directory for changes made outside tv2.
+
+A PlainTextNoteBook reads its notes directory once, when it's made. A watcher
+notices note files being created, modified, deleted or moved afterwards (by
+sync tools, scripts, another terminal...) and updates the notebook to match,
+using PlainTextNoteBook's add_existing(), note_changed() and forget() methods.
+Anything listening to the notebook, such as an IndexedSearch, hears about the
+changes in turn.
+
+    watcher = watch.watch_notebook(notebook)
+    loop.watch_file(watcher.fileno(), watcher.process_events)
+
+Every watcher has a fileno() that becomes readable when there are changes to
+process, so it can be hooked into an event loop such as urwid's, and a
+process_events() method that applies the changes to the notebook. Call
+process_events() from the same thread that uses the notebook.
+
+On Linux InotifyWatcher gets change events from the kernel using inotify
+(through ctypes, no extra dependencies). Elsewhere, or if inotify can't be
+used, PollingWatcher rescans the notes directory in a background thread
+every few seconds.
+
+Making a watcher doesn't scan the notes directory in the calling thread.
+Watchers start from the directory records of the notebook's own scan (see
+PlainTextNoteBook.take_scan_records()), then scan the notes directory once in
+a background thread and compare it with the notebook, to catch any changes
+made between the notebook reading the directory and the watcher starting.
+
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+logger = logging.getLogger(__name__)
+import os
+import select
+import struct
+import threading
+
+from . import notebook as notebook_module
+
+
+# inotify constants, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+EVENT_HEADER = struct.Struct("iIII")
+
+# How often PollingWatcher rescans the notes directory, in seconds.
+DEFAULT_POLL_INTERVAL = 3.0
+
+
+class Watcher(object):
+    """Base class for notes directory watchers.
+
+    Subclasses collect the paths of changed files, relative to the notes
+    directory, and call _sync_file() or _sync_dir() for each of them to bring
+    the notebook up to date with what's on disk. Notes whose files have gone
+    are collected by _sync_file() and forgotten together by _forget(), so
+    that deleting many files at once doesn't cost a pass over the notebook
+    for each of them.
+
+    Background threads hand changed files and newly found directories over
+    with _post(), which makes _read_fd readable, and process_events() takes
+    them with _take_posted().
+
+    """
+    def __init__(self, notebook):
+        self.notebook = notebook
+        self._posted_files = set()
+        self._posted_dirs = set()
+        self._lock = threading.Lock()
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+
+    def fileno(self):
+        """Return a file descriptor that is readable when there are changes.
+
+        """
+        raise NotImplementedError
+
+    def process_events(self):
+        """Apply any pending changes to the notebook.
+
+        Returns True if the notebook changed.
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _post(self, files=(), dirs=()):
+        """Hand changed files and found directories (paths relative to the
+        notes directory) to process_events(). May be called from any
+        thread."""
+
+        with self._lock:
+            self._posted_files.update(files)
+            self._posted_dirs.update(dirs)
+        os.write(self._write_fd, b"\n")
+
+    def _take_posted(self):
+        """Return the (files, dirs) posted since the last call."""
+
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError:
+            # Nothing more to read.
+            pass
+        with self._lock:
+            files, self._posted_files = self._posted_files, set()
+            dirs, self._posted_dirs = self._posted_dirs, set()
+        return files, dirs
+
+    def _scan(self):
+        """Scan the notes directory.
+
+        Returns a (state, reldirs) tuple: a dict mapping the path of each
+        note file to its (mtime, size), and a list of the paths of the
+        directories. Paths are relative to the notes directory.
+
+        """
+        notebook = self.notebook
+        records = {}
+        for _ in notebook_module.scan_notes_dir(notebook.path,
+                notebook.extensions, notebook.exclude, manifest=records):
+            pass
+        state = {}
+        for mtime, subdirs, notes in records.values():
+            for title, extension, note_mtime, size, ctime in notes:
+                state[title + extension] = (note_mtime, size)
+        return state, list(records)
+
+    def _changed_since_loaded(self, state):
+        """Return the paths of the note files that the notebook doesn't
+        agree with the disk about, given the `state` returned by _scan().
+
+        Those are files that it has no note for, notes whose files have gone,
+        and notes whose mtime has been read and is different. Notes whose
+        mtime hasn't been read yet will get the new one when it is. This
+        doesn't change the notebook, so it can be called from a background
+        thread.
+
+        """
+        notebook = self.notebook
+        changed = set()
+        for relpath, (mtime, size) in state.items():
+            note = notebook.note_for_filename(relpath)
+            if note is None:
+                changed.add(relpath)
+                continue
+            known_mtime = getattr(note, "cached_mtime", None)
+            if known_mtime is not None and known_mtime != mtime / 1e9:
+                changed.add(relpath)
+        for note in list(notebook):
+            relpath = note.title + note.extension
+            if relpath not in state:
+                changed.add(relpath)
+        return changed
+
+    def _is_note_file(self, relpath):
+        notebook = self.notebook
+        for name in relpath.split(os.sep)[:-1]:
+            if name in notebook.exclude:
+                return False
+        return notebook_module.is_note_filename(os.path.basename(relpath),
+                notebook.extensions, notebook.exclude)
+
+    def _sync_file(self, relpath, gone):
+        """Make the notebook agree with the disk about the file `relpath`.
+
+        If its file has gone the note is appended to the list `gone` rather
+        than forgotten straight away, see _forget(). Returns True if the
+        notebook changed, or will when `gone` is forgotten.
+
+        """
+        if not self._is_note_file(relpath):
+            return False
+        title, extension = os.path.splitext(relpath)
+        note = self.notebook.get_note(title, extension)
+        exists = os.path.isfile(os.path.join(self.notebook.path, relpath))
+        if exists and note is None:
+            self.notebook.add_existing(title, extension)
+        elif exists:
+            self.notebook.note_changed(note)
+        elif note is not None:
+            gone.append(note)
+        else:
+            return False
+        return True
+
+    def _sync_dir(self, reldir):
+        """Make the notebook agree with the disk about the directory `reldir`.
+
+        Notes in a directory that has gone are forgotten, and note files in a
+        directory that has appeared are added. Returns the directory records
+        (see notebook.scan_notes_dir()) of `reldir` and its subdirectories,
+        relative to `reldir`.
+
+        """
+        notebook = self.notebook
+        path = os.path.join(notebook.path, reldir)
+        exists = os.path.isdir(path)
+        self._forget([note for note in self._notes_in(reldir)
+            if not (exists and os.path.isfile(note.abspath))])
+
+        records = {}
+        if exists:
+            for batch in notebook_module.scan_notes_dir(path,
+                    notebook.extensions, notebook.exclude, manifest=records):
+                for title, extension in batch:
+                    notebook.add_existing(os.path.join(reldir, title),
+                            extension)
+        return records
+
+    def _notes_in(self, reldir):
+        """Return the notebook's notes in the directory `reldir` and its
+        subdirectories."""
+
+        notebook = self.notebook
+        if not reldir:
+            return list(notebook)
+        prefix = reldir + os.sep
+        # The notebook finds the notes by bisecting its title ordering.
+        notes_with_title_prefix = getattr(
+                notebook, "notes_with_title_prefix", None)
+        if notes_with_title_prefix is not None:
+            notes = notes_with_title_prefix(prefix)
+        else:
+            notes = notebook
+        # notes_with_title_prefix() ignores case.
+        return [note for note in notes if note.title.startswith(prefix)]
+
+    def _forget(self, notes):
+        """Forget the notes in the list `notes`, whose files have gone."""
+
+        if not notes:
+            return
+        forget_notes = getattr(self.notebook, "forget_notes", None)
+        if forget_notes is not None:
+            forget_notes(notes)
+        else:
+            for note in notes:
+                self.notebook.forget(note)
+
+
+class InotifyWatcher(Watcher):
+    """Watches a notes directory using Linux's inotify.
+
+    Its fileno() is an epoll file descriptor that's readable when there are
+    inotify events or the background check has posted changes.
+
+    """
+    def __init__(self, notebook, records=None):
+        """Start watching the notes directory of `notebook`.
+
+        Raises OSError if inotify isn't available.
+
+        Arguments:
+        records -- the directory records of the notebook's scan of its notes
+            directory (see PlainTextNoteBook.take_scan_records()), its
+            directories are watched straight away. Without them only the
+            notes directory itself is, until the background check has found
+            the rest (dict)
+
+        """
+        self._libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        try:
+            self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        super(InotifyWatcher, self).__init__(notebook)
+        self._dirs = {}  # reldir -> watch descriptor
+        self._wds = {}  # watch descriptor -> reldir
+
+        if not self._add_watch(""):
+            for fd in (self._fd, self._read_fd, self._write_fd):
+                os.close(fd)
+            raise OSError("Could not watch {0}".format(notebook.path))
+        if records is not None:
+            self._add_watches("", records)
+        self._epoll = select.epoll()
+        self._epoll.register(self._fd, select.EPOLLIN)
+        self._epoll.register(self._read_fd, select.EPOLLIN)
+
+        # The directories are watched now, so changes from here on will be
+        # heard about. Look for any made before, and directories that the
+        # records don't have, without holding up the caller.
+        thread = threading.Thread(target=self._check, name="tv2-watch-check")
+        thread.daemon = True
+        thread.start()
+
+    def fileno(self):
+        return self._epoll.fileno()
+
+    def close(self):
+        self._epoll.close()
+        os.close(self._fd)
+
+    def _check(self):
+        try:
+            state, reldirs = self._scan()
+            self._post(self._changed_since_loaded(state), reldirs)
+        except Exception as e:
+            logger.exception(e)
+
+    def _add_watch(self, reldir):
+        path = os.path.join(self.notebook.path, reldir)
+        wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            logger.warning("Could not watch {0}: {1}".format(
+                path, os.strerror(ctypes.get_errno())))
+            return False
+        self._dirs[reldir] = wd
+        self._wds[wd] = reldir
+        return True
+
+    def _add_watches(self, reldir, records):
+        for subdir in records:
+            if subdir:
+                self._add_watch(os.path.join(reldir, subdir))
+
+    def _remove_watches(self, reldir):
+        prefix = reldir + os.sep
+        for subdir in list(self._dirs):
+            if subdir == reldir or subdir.startswith(prefix):
+                wd = self._dirs.pop(subdir)
+                del self._wds[wd]
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self):
+        """Return a list of (mask, relpath) tuples for the pending events."""
+
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(
+                        data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_IGNORED:
+                    reldir = self._wds.pop(wd, None)
+                    if reldir is not None:
+                        self._dirs.pop(reldir, None)
+                    continue
+                if mask & IN_Q_OVERFLOW:
+                    events.append((mask, None))
+                    continue
+                reldir = self._wds.get(wd)
+                if reldir is None:
+                    continue
+                events.append(
+                        (mask, os.path.join(reldir, os.fsdecode(name))))
+        return events
+
+    def process_events(self):
+        changed = False
+        files, found_dirs = self._take_posted()
+        for reldir in found_dirs:
+            if reldir not in self._dirs:
+                self._add_watch(reldir)
+        dirs = set()
+        for mask, relpath in self._read_events():
+            if relpath is None:
+                # The kernel dropped events, check everything.
+                logger.warning("inotify queue overflowed, rescanning")
+                dirs.add("")
+            elif mask & IN_ISDIR:
+                if os.path.basename(relpath) not in self.notebook.exclude:
+                    dirs.add(relpath)
+            else:
+                files.add(relpath)
+
+        # A file may have been created and deleted, or an editor may have
+        # saved it by writing a new file and renaming it over the old one, so
+        # only the final state of each file on disk matters.
+        gone = []
+        for relpath in files:
+            if self._sync_file(relpath, gone):
+                changed = True
+        self._forget(gone)
+
+        for reldir in dirs:
+            len_before = len(self.notebook)
+            if reldir:
+                self._remove_watches(reldir)
+                if os.path.isdir(os.path.join(self.notebook.path, reldir)):
+                    self._add_watch(reldir)
+            records = self._sync_dir(reldir)
+            self._add_watches(reldir, records)
+            if len(self.notebook) != len_before:
+                changed = True
+        return changed
+
+
+class PollingWatcher(Watcher):
+    """Watches a notes directory by rescanning it every few seconds.
+
+    The rescanning is done in a background thread, the changes it finds are
+    applied to the notebook by process_events(). The first scan is done
+    straight away and compared with the notebook.
+
+    """
+    def __init__(self, notebook, interval=DEFAULT_POLL_INTERVAL):
+        super(PollingWatcher, self).__init__(notebook)
+        self.interval = interval
+        self._stopped = threading.Event()
+        thread = threading.Thread(target=self._run, name="tv2-poll")
+        thread.daemon = True
+        thread.start()
+
+    def fileno(self):
+        return self._read_fd
+
+    def close(self):
+        self._stopped.set()
+
+    def _run(self):
+        try:
+            previous_state, _ = self._scan()
+            changed = self._changed_since_loaded(previous_state)
+        except Exception as e:
+            logger.exception(e)
+            return
+        if changed:
+            self._post(changed)
+        while not self._stopped.wait(self.interval):
+            state, _ = self._scan()
+            changed = set(relpath for relpath, stat in state.items()
+                    if previous_state.get(relpath) != stat)
+            changed.update(set(previous_state) - set(state))
+            previous_state = state
+            if changed:
+                self._post(changed)
+
+    def process_events(self):
+        changed, _ = self._take_posted()
+        result = False
+        gone = []
+        for relpath in changed:
+            if self._sync_file(relpath, gone):
+                result = True
+        self._forget(gone)
+        return result
+
+
+def watch_notebook(notebook, poll_interval=DEFAULT_POLL_INTERVAL):
+    """Return a watcher for `notebook`'s notes directory.
+
+    Uses inotify if it can, otherwise falls back to polling. Call this once
+    the notebook has been loaded, the watcher takes the records of its scan.
+
+    """
+    take_scan_records = getattr(notebook, "take_scan_records", None)
+    records = None if take_scan_records is None else take_scan_records()
+    try:
+        return InotifyWatcher(notebook, records)
+    except OSError as e:
+        logger.info("Not using inotify ({0}), polling for changes".format(e))
+        return PollingWatcher(notebook, interval=poll_interval)